@@ -0,0 +1,168 @@
+import os
+import sys
+import time
+import secrets
+import argparse
+import threading
+import subprocess
+from multiprocessing.connection import Listener
+
+
+def get_gpu_ids():
+    if os.environ.get('CUDA_VISIBLE_DEVICES'):
+        return os.environ['CUDA_VISIBLE_DEVICES'].split(',')
+    if os.environ.get('SLURM_GPUS_ON_NODE'):
+        return [str(i) for i in range(int(os.environ['SLURM_GPUS_ON_NODE']))]
+    return ['0']
+
+
+class SampleQueue:
+    # Hands out indices into the sample list every worker builds for itself. Indices of workers that disconnect
+    # without finishing are handed out again, until they have failed max_attempts times.
+
+    def __init__(self, max_attempts=2):
+        self.lock = threading.Lock()
+        self.max_attempts = max_attempts
+        self.next_index = 0
+        self.end_index = None
+        self.retry_indices = []
+        self.attempts = {}
+        self.failed_indices = []
+
+    def get_index(self):
+        with self.lock:
+            if self.retry_indices:
+                index = self.retry_indices.pop()
+            else:
+                index = self.next_index
+                self.next_index += 1
+            self.attempts[index] = self.attempts.get(index, 0) + 1
+            return index
+
+    def retry(self, index):
+        with self.lock:
+            if self.attempts[index] >= self.max_attempts:
+                print(f'Sample index {index} failed {self.attempts[index]} times, dropping it')
+                self.failed_indices.append(index)
+            else:
+                print(f'Worker disconnected while rendering sample index {index}, queuing it again')
+                self.retry_indices.append(index)
+
+    def stop(self, index):
+        # workers announce the size of their sample list and stop at the first index past its end
+        with self.lock:
+            if self.end_index is None or index < self.end_index:
+                self.end_index = index
+
+    def get_unfinished(self):
+        # failed, still queued and never handed out indices. Without an end, the samples from next_index on are unknown
+        with self.lock:
+            if self.end_index is None:
+                missing_indices = f'{self.next_index} and later'
+            else:
+                missing_indices = list(range(self.next_index, self.end_index))
+            return sorted(self.failed_indices), sorted(self.retry_indices), missing_indices
+
+    def serve(self, connection):
+        current_index = None
+        try:
+            while True:
+                message = connection.recv()
+                if message == 'next':
+                    current_index = self.get_index()
+                    connection.send(current_index)
+                elif message == 'stop':
+                    self.stop(current_index)
+                    current_index = None
+                elif isinstance(message, tuple) and message[0] == 'size':
+                    self.stop(message[1])
+        except EOFError:
+            if current_index is not None:
+                self.retry(current_index)
+        finally:
+            connection.close()
+
+
+def accept_connections(listener, sample_queue):
+    while True:
+        connection = listener.accept()
+        threading.Thread(target=sample_queue.serve, args=(connection,), daemon=True).start()
+
+
+def start_worker(command, worker_id, gpu_id, address, authkey):
+    env = dict(
+        os.environ,
+        CUDA_VISIBLE_DEVICES=gpu_id,
+        RENDER_WORKER_ID=str(worker_id),
+        RENDER_QUEUE_ADDRESS=f'{address[0]}:{address[1]}',
+        RENDER_QUEUE_AUTHKEY=authkey,
+    )
+    print(f'Starting worker {worker_id} on GPU {gpu_id}')
+    return subprocess.Popen(command, env=env)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Runs one renderer per GPU. The workers share one queue of samples.",
+        usage="python functions/dispatcher.py [--workers N] [-- worker command]"
+    )
+    parser.add_argument('--workers', type=int, default=None, help="number of workers (default: one per GPU)")
+    parser.add_argument('--max-restarts', type=int, default=3, help="restarts per worker after a crash")
+    parser.add_argument('--max-attempts', type=int, default=2, help="renders of a sample before it is dropped")
+    if '--' in sys.argv:
+        arguments = parser.parse_args(sys.argv[1:sys.argv.index('--')])
+        command = sys.argv[sys.argv.index('--') + 1:]
+    else:
+        arguments = parser.parse_args()
+        # without --python-exit-code blender exits with 0 even if the script raised
+        command = ['blender', '--background', '--python-exit-code', '1', '--python', 'functions/renderer.py']
+
+    gpu_ids = get_gpu_ids()
+    workers = arguments.workers or len(gpu_ids)
+
+    authkey = secrets.token_hex(16)
+    listener = Listener(('localhost', 0), authkey=authkey.encode())
+    sample_queue = SampleQueue(arguments.max_attempts)
+    threading.Thread(target=accept_connections, args=(listener, sample_queue), daemon=True).start()
+
+    processes = {}
+    restarts = {}
+    for worker_id in range(workers):
+        gpu_id = gpu_ids[worker_id % len(gpu_ids)]
+        processes[worker_id] = start_worker(command, worker_id, gpu_id, listener.address, authkey)
+        restarts[worker_id] = 0
+
+    failed = False
+    while processes:
+        time.sleep(5)
+        for worker_id, process in list(processes.items()):
+            return_code = process.poll()
+            if return_code is None:
+                continue
+
+            del processes[worker_id]
+            if return_code == 0:
+                print(f'Worker {worker_id} finished')
+            elif restarts[worker_id] < arguments.max_restarts:
+                restarts[worker_id] += 1
+                print(f'Worker {worker_id} failed with exit code {return_code}, restarting it')
+                gpu_id = gpu_ids[worker_id % len(gpu_ids)]
+                processes[worker_id] = start_worker(command, worker_id, gpu_id, listener.address, authkey)
+            else:
+                print(f'Worker {worker_id} failed with exit code {return_code}, giving up')
+                failed = True
+
+    # samples of a crashed worker are only rendered again if another worker was still asking for samples
+    failed_indices, retry_indices, missing_indices = sample_queue.get_unfinished()
+    if failed_indices:
+        print(f'{len(failed_indices)} samples failed {arguments.max_attempts} times, indices {failed_indices}')
+        failed = True
+    if retry_indices:
+        print(f'{len(retry_indices)} samples of crashed workers were not rendered again, indices {retry_indices}')
+        failed = True
+    if missing_indices:
+        print(f'Samples that were never handed out: indices {missing_indices}')
+        failed = True
+
+    sys.exit(1 if failed else 0)
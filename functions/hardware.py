@@ -0,0 +1,10 @@
+import os
+
+
+def get_cpu_count():
+    # slurm may assign fewer CPUs than the node has
+    if 'SLURM_CPUS_PER_TASK' in os.environ:
+        return int(os.environ['SLURM_CPUS_PER_TASK'])
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
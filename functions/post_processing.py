@@ -1,43 +1,88 @@
 import os
+import io
 import json
+import time
 import shutil
+import hashlib
+import tarfile
 import numpy as np
 import matplotlib.pyplot as plt
 from PIL import Image
 from pathlib import Path
-from copy import deepcopy
+from collections import Counter, defaultdict
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
+from hardware import get_cpu_count
+from render_manifest import read_render_manifest
 
-def create_white_background(
-        input_folder, output_folder, object_number, mask_image_number, image_number, new_image_name,
-        background_change, shadow_contrast_multiplier, object_contrast_multiplier):
 
-    pic_1 = Image.open(f"{input_folder}/{object_number}__{mask_image_number}.png")
-    pic_2 = Image.open(f"{input_folder}/{object_number}__{image_number}.png")
-    pic_1 = pic_1.resize(pic_2.size)
+@lru_cache(maxsize=None)
+def get_white_background_lut(background_change, shadow_contrast_multiplier, object_contrast_multiplier):
+    # output value for every (mask value, image value) pair, so an image needs one table lookup per channel
+    mask = np.minimum(np.arange(256, dtype='float64') / 230, 1)[:, np.newaxis]
+    values = np.arange(256, dtype='float64')[np.newaxis, :]
+
+    new_object = np.minimum(values * object_contrast_multiplier, 255)
 
-    pic_1_array = np.array(pic_1).astype('float64')
-    pic_2_array = np.array(pic_2).astype('float64')
+    new_background = np.minimum(values + background_change, 255)
+    new_background = np.maximum((new_background - 255) * shadow_contrast_multiplier + 255, 0)
 
-    mask_array = pic_1_array / 230
-    mask_array[mask_array > 1] = 1
+    new_array = mask * new_background + (1 - mask) * new_object
+    return np.uint8(new_array).ravel()
 
-    new_object = deepcopy(pic_2_array)
-    new_object *= object_contrast_multiplier
-    new_object[new_object > 255] = 255
 
-    new_background = deepcopy(pic_2_array)
-    new_background += background_change
-    new_background[new_background >= 255] = 255
-    new_background -= 255
-    new_background *= shadow_contrast_multiplier
-    new_background += 255
-    new_background[new_background < 0] = 0
+def get_rgb_array(image):
+    if image.mode not in ['RGB', 'RGBA']:
+        image = image.convert('RGB')
+    return np.asarray(image)[:, :, :3]
+
+
+def get_resized_image(image, new_size):
+    # the renders are exact multiples of the training size, a box reduce is much cheaper than a bicubic resize
+    factor = image.size[0] // new_size[0]
+    if factor > 1 and image.size == (new_size[0] * factor, new_size[1] * factor):
+        return image.reduce(factor)
+    if image.size != tuple(new_size):
+        return image.resize(new_size)
+    return image
 
-    new_array = mask_array * new_background + (1 - mask_array) * new_object
-    new_image = Image.fromarray(np.uint8(new_array)).convert('RGB')
-    new_image.save(f"{output_folder}/{new_image_name}.png")
-    # new_image.show()
+
+def get_white_background_images(input_folder, object_number, mask_image, variants):
+    # variants: (image_number, new_image_name, background_change, shadow_contrast_multiplier,
+    # object_contrast_multiplier). The mask is resized once for all of them.
+    mask_indices = {}
+    images = {}
+
+    for image_number, new_image_name, background_change, shadow_contrast_multiplier, object_contrast_multiplier \
+            in variants:
+        image = Image.open(f"{input_folder}/{object_number}__{image_number}.png")
+        if image.size not in mask_indices:
+            mask_array = get_rgb_array(get_resized_image(mask_image, image.size))
+            mask_indices[image.size] = mask_array.astype('uint16') << 8
+
+        lut = get_white_background_lut(background_change, shadow_contrast_multiplier, object_contrast_multiplier)
+        new_array = lut.take(mask_indices[image.size] | get_rgb_array(image))
+        images[new_image_name] = Image.fromarray(new_array, 'RGB')
+
+    return images
+
+
+def create_white_backgrounds(input_folder, output_folder, object_number, mask_image_number, variants):
+    mask_image = Image.open(f"{input_folder}/{object_number}__{mask_image_number}.png")
+    images = get_white_background_images(input_folder, object_number, mask_image, variants)
+    for new_image_name, image in images.items():
+        image.save(f"{output_folder}/{new_image_name}.png")
+
+
+def create_white_background(
+        input_folder, output_folder, object_number, mask_image_number, image_number, new_image_name,
+        background_change, shadow_contrast_multiplier, object_contrast_multiplier):
+
+    create_white_backgrounds(
+        input_folder, output_folder, object_number, mask_image_number,
+        [(image_number, new_image_name, background_change, shadow_contrast_multiplier, object_contrast_multiplier)]
+    )
 
 
 def create_histogram(image):
@@ -73,17 +118,38 @@ def create_folder(folder_path, remove_content):
     directory.mkdir(parents=True, exist_ok=True)
 
 
-def copy_image(
-        input_folder, output_folder, object_number, image_number, new_image_name, is_grayscale=False, new_size=None):
-
-    image = Image.open(f"{input_folder}/{object_number}__{image_number}.png")
+def convert_image(image, is_grayscale=False, new_size=None):
     if new_size is not None:
-        image = image.resize(new_size)
+        image = get_resized_image(image, new_size)
     if is_grayscale:
         image = image.convert('L')
     else:
         image = image.convert('RGB')
 
+    return image
+
+
+def get_converted_image(input_folder, object_number, image_number, is_grayscale=False, new_size=None):
+    image = Image.open(f"{input_folder}/{object_number}__{image_number}.png")
+    return convert_image(image, is_grayscale, new_size)
+
+
+def get_image_format(config):
+    # file extension and PIL save arguments of the converted images. PNG encoding is most of the post processing
+    # time, a lower compress level trades file size for speed
+    if config.get('image_format', 'png') == 'webp':
+        return 'webp', {'format': 'WEBP', 'lossless': True}
+
+    save_arguments = {'format': 'PNG'}
+    if 'png_compress_level' in config:
+        save_arguments['compress_level'] = config['png_compress_level']
+    return 'png', save_arguments
+
+
+def copy_image(
+        input_folder, output_folder, object_number, image_number, new_image_name, is_grayscale=False, new_size=None):
+
+    image = get_converted_image(input_folder, object_number, image_number, is_grayscale, new_size)
     image.save(f"{output_folder}/{new_image_name}.png")
 
 
@@ -91,6 +157,302 @@ def list_sub_directories(directory):
     return [item for item in os.listdir(directory) if os.path.isdir(os.path.join(directory, item))]
 
 
+SPLITS = ['test', 'validation', 'training']
+OBJECT_FILES = ['1.png', '2.png', '3.png', '4.png', '11.png', '10.png', '8.png', '0.json']
+
+
+def load_render_manifest(folder):
+    # files of every finished sample as recorded by the renderer, None for experiments without manifests
+    if not os.path.isdir(f'{folder}/manifests'):
+        return None
+
+    return {str(record['sample']): set(record['files']) for record in read_render_manifest(folder)}
+
+
+def get_experiment_objects(folder):
+    # the render manifest or a single directory scan gives the files of every object, no file is checked with a
+    # separate stat call
+    object_files = load_render_manifest(folder)
+    if object_files is None:
+        object_files = defaultdict(set)
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                object_number, separator, file = entry.name.partition('__')
+                if separator and entry.is_file():
+                    object_files[object_number].add(file)
+
+    complete_objects = []
+    incomplete_objects = {}
+    for object_number, files in object_files.items():
+        missing_files = [file for file in OBJECT_FILES if file not in files]
+        if missing_files:
+            incomplete_objects[object_number] = missing_files
+        else:
+            complete_objects.append(object_number)
+
+    return complete_objects, incomplete_objects
+
+
+def get_hash_split(object_name, split_ratios):
+    # stable position of the object in [0, 1), so every worker places an object the same way without coordination
+    position = int(hashlib.sha1(object_name.encode()).hexdigest()[:15], 16) / 16 ** 15
+
+    threshold = 0
+    for split in ['test', 'validation']:
+        threshold += split_ratios[split]
+        if position < threshold:
+            return split
+    return 'training'
+
+
+def get_balanced_split(split_counts, split_ratios):
+    # depends on the processing order, only for reproducing older datasets
+    object_count = sum(split_counts.values())
+    if split_counts['test'] < object_count * split_ratios['test']:
+        return 'test'
+    elif split_counts['validation'] < object_count * split_ratios['validation']:
+        return 'validation'
+    return 'training'
+
+
+def load_split_manifest(preprocessed_folder):
+    # object name -> split, one json line per finished object. Older outputs without a manifest are indexed
+    # once from the split folders, after that the folders are never listed again
+    manifest_file = f'{preprocessed_folder}/manifest.jsonl'
+    manifest = {}
+
+    if not os.path.isfile(manifest_file):
+        with open(manifest_file, 'w') as f:
+            for split in SPLITS:
+                for object_name in list_sub_directories(f'{preprocessed_folder}/{split}'):
+                    manifest[object_name] = split
+                    f.write(json.dumps({'object': object_name, 'split': split}) + '\n')
+        return manifest
+
+    with open(manifest_file) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # last line of an interrupted run
+                continue
+            manifest[entry['object']] = entry['split']
+
+    return manifest
+
+
+def append_to_split_manifest(manifest_file, object_name, split):
+    manifest_file.write(json.dumps({'object': object_name, 'split': split}) + '\n')
+    manifest_file.flush()
+
+
+def get_object_images(folder, object_number):
+    # every source file is decoded once, the mask is shared by the mask output and the white backgrounds
+    mask_image = Image.open(f"{folder}/{object_number}__4.png")
+    mask_image.load()
+
+    images = {
+        'input': get_converted_image(folder, object_number, 1),
+        'normals': get_converted_image(folder, object_number, 2),
+        'distance': get_converted_image(folder, object_number, 3, is_grayscale=True),
+        'mask': convert_image(mask_image, is_grayscale=True, new_size=(1024, 1024)),
+    }
+    images.update(get_white_background_images(folder, object_number, mask_image, [
+        (11, 'output_1', 85, 1.4, 1.2),
+        (10, 'output_2', 55, 1.6, 1.15),
+        (8, 'output_3', 35, 1, 1),
+    ]))
+
+    return images
+
+
+def process_object(folder, new_folder, object_number, image_format=('png', {'format': 'PNG'})):
+    start_time = time.time()
+
+    extension, save_arguments = image_format
+    create_folder(new_folder, remove_content=True)
+    for new_image_name, image in get_object_images(folder, object_number).items():
+        image.save(f"{new_folder}/{new_image_name}.{extension}", **save_arguments)
+    shutil.copy(f'{folder}/{object_number}__0.json', f'{new_folder}/metadata.json')
+
+    return time.time() - start_time, None
+
+
+def encode_object(folder, object_number, image_format=('png', {'format': 'PNG'})):
+    # same files as process_object, but returned as bytes so the main process can pack them into a shard
+    start_time = time.time()
+
+    extension, save_arguments = image_format
+    files = {}
+    for new_image_name, image in get_object_images(folder, object_number).items():
+        buffer = io.BytesIO()
+        image.save(buffer, **save_arguments)
+        files[f'{new_image_name}.{extension}'] = buffer.getvalue()
+    with open(f'{folder}/{object_number}__0.json', 'rb') as f:
+        files['metadata.json'] = f.read()
+
+    return time.time() - start_time, files
+
+
+def get_object_arrays(folder, object_number):
+    images = get_object_images(folder, object_number)
+    return {new_image_name: np.asarray(image) for new_image_name, image in images.items()}
+
+
+def get_object_shapes(folder, object_number):
+    return {new_image_name: array.shape for new_image_name, array in get_object_arrays(folder, object_number).items()}
+
+
+def store_object(folder, object_number, store_folder, row):
+    # writes straight into the row the main process reserved, the arrays never go through the process pool
+    start_time = time.time()
+
+    for new_image_name, array in get_object_arrays(folder, object_number).items():
+        store = np.load(f'{store_folder}/{new_image_name}.npy', mmap_mode='r+')
+        store[row] = array
+        store.flush()
+        del store
+    with open(f'{folder}/{object_number}__0.json') as f:
+        metadata = json.load(f)
+
+    return time.time() - start_time, metadata
+
+
+class FolderOutput:
+    # the workers already wrote the object folder, only the manifest is left
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+
+    def add(self, object_name, split, files):
+        append_to_split_manifest(self.manifest_file, object_name, split)
+
+    def close(self):
+        pass
+
+
+class ShardOutput:
+    # packs the objects of every split into numbered tar shards in the WebDataset layout (<object>.<file>). A shard
+    # is written as .tar.partial and only renamed, indexed and added to the manifest once it is full, so the objects
+    # of a shard that was interrupted are converted again on the next run
+    def __init__(self, preprocessed_folder, manifest_file, shard_size_mb):
+        self.preprocessed_folder = preprocessed_folder
+        self.manifest_file = manifest_file
+        self.max_shard_size = shard_size_mb * 1024 * 1024
+        self.shards = {}
+        self.shard_numbers = {}
+
+        for split in SPLITS:
+            shard_numbers = [-1]
+            for file in os.listdir(f'{preprocessed_folder}/{split}'):
+                if file.endswith('.tar.partial'):
+                    os.remove(f'{preprocessed_folder}/{split}/{file}')
+                elif file.startswith('shard_') and file.endswith('.tar'):
+                    shard_numbers.append(int(file[len('shard_'):-len('.tar')]))
+            self.shard_numbers[split] = max(shard_numbers) + 1
+
+    def open_shard(self, split):
+        shard_name = f'shard_{self.shard_numbers[split]:06d}.tar'
+        self.shard_numbers[split] += 1
+        shard_path = f'{self.preprocessed_folder}/{split}/{shard_name}'
+        self.shards[split] = {
+            'name': shard_name,
+            'path': shard_path,
+            'tar': tarfile.open(f'{shard_path}.partial', 'w', format=tarfile.USTAR_FORMAT),
+            'entries': [],
+        }
+        return self.shards[split]
+
+    def add(self, object_name, split, files):
+        shard = self.shards.get(split) or self.open_shard(split)
+
+        # byte offset and size of every file, so single objects can be read without scanning the shard
+        members = {}
+        for file_name, data in files.items():
+            info = tarfile.TarInfo(f'{object_name}.{file_name}')
+            info.size = len(data)
+            info.mtime = int(time.time())
+            shard['tar'].addfile(info, io.BytesIO(data))
+            padded_size = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            members[file_name] = [shard['tar'].offset - padded_size, info.size]
+
+        shard['entries'].append({'object': object_name, 'shard': shard['name'], 'members': members})
+        if shard['tar'].offset >= self.max_shard_size:
+            self.close_shard(split)
+
+    def close_shard(self, split):
+        shard = self.shards.pop(split)
+        shard['tar'].close()
+        os.replace(f'{shard["path"]}.partial', shard['path'])
+
+        with open(f'{self.preprocessed_folder}/{split}/index.jsonl', 'a') as f:
+            for entry in shard['entries']:
+                f.write(json.dumps(entry) + '\n')
+        for entry in shard['entries']:
+            append_to_split_manifest(self.manifest_file, entry['object'], split)
+
+    def close(self):
+        for split in list(self.shards):
+            self.close_shard(split)
+
+
+class TensorOutput:
+    # one uint8 .npy array per image and split with a row per object, so loaders can open them with
+    # np.load(..., mmap_mode='r') and slice samples without decoding. Every run adds a new part (tensors_000000,
+    # tensors_000001, ...) sized for the objects of that run. metadata.jsonl lists the row of every finished object,
+    # rows of objects that failed stay empty
+    def __init__(self, preprocessed_folder, manifest_file, shapes, object_counts):
+        self.manifest_file = manifest_file
+        self.stores = {}
+
+        for split, object_count in object_counts.items():
+            split_folder = f'{preprocessed_folder}/{split}'
+            parts = [int(file[len('tensors_'):]) for file in os.listdir(split_folder) if file.startswith('tensors_')]
+            store_folder = f'{split_folder}/tensors_{max(parts, default=-1) + 1:06d}'
+            create_folder(store_folder, remove_content=False)
+
+            for new_image_name, shape in shapes.items():
+                store = np.lib.format.open_memmap(
+                    f'{store_folder}/{new_image_name}.npy', mode='w+', dtype=np.uint8, shape=(object_count, *shape))
+                del store
+            self.stores[split] = {'folder': store_folder, 'rows': 0, 'object_rows': {}}
+
+    def get_row(self, split, object_name):
+        store = self.stores[split]
+        row = store['rows']
+        store['rows'] += 1
+        store['object_rows'][object_name] = row
+        return store['folder'], row
+
+    def add(self, object_name, split, metadata):
+        store = self.stores[split]
+        with open(f'{store["folder"]}/metadata.jsonl', 'a') as f:
+            row = store['object_rows'].pop(object_name)
+            f.write(json.dumps({'row': row, 'object': object_name, 'metadata': metadata}) + '\n')
+        append_to_split_manifest(self.manifest_file, object_name, split)
+
+    def close(self):
+        pass
+
+
+def report_finished(futures, tasks, finished_count, split_counts, output):
+    for future in futures:
+        finished_count += 1
+        object_name, split, new_folder = tasks.pop(future)
+        try:
+            duration, files = future.result()
+        except Exception as e:
+            if new_folder is not None:
+                shutil.rmtree(new_folder, ignore_errors=True)
+            split_counts[split] -= 1
+            print(f"[{finished_count}] Object {object_name} failed: {e!r}")
+            continue
+        # only finished objects go into the manifest, so an interrupted object is redone on the next run
+        output.add(object_name, split, files)
+        print(f"[{finished_count}] Object {object_name} -> {split} ({duration:.1f}s)")
+
+    return finished_count
+
+
 if __name__ == "__main__":
 
     assert Path("./config.json").exists(), "config not found. copy config.json to create config_local.json!"
@@ -99,52 +461,80 @@ if __name__ == "__main__":
 
     preprocessed_folder = f'./output/{config["preprocessed_name"]}'
     create_folder(f'{preprocessed_folder}', remove_content=False)
-    for folder_name in ['test', 'validation', 'training']:
+    for folder_name in SPLITS:
         create_folder(f'{preprocessed_folder}/{folder_name}', remove_content=False)
 
+    split_method = config.get('split_method', 'hash')
+    split_ratios = {'test': 0.1, 'validation': 0.2}
+    split_ratios.update(config.get('split_ratios', {}))
+    assert split_method in ['hash', 'balanced'], f"unknown split method {split_method}"
+    output_mode = config.get('preprocessing_output', 'folders')
+    image_format = get_image_format(config)
+    assert output_mode in ['folders', 'shards', 'tensors'], f"unknown preprocessing output {output_mode}"
+
+    # splits are assigned here, only the image work is spread over the process pool
+    manifest = load_split_manifest(preprocessed_folder)
+    split_counts = Counter(manifest.values())
+
+    # the splits of all objects are known before the first one is converted, so stores can be sized up front
+    pending_objects = []
     experiments = config["preprocessing_experiment_names"]
     for experiment in experiments:
         folder = f'./output/{experiment}'
 
-        object_numbers = []
-        for file in os.listdir(folder):
-            if file.endswith(".json"):
-                object_number = file.split('__')[0]
-                object_numbers.append(object_number)
+        object_numbers, incomplete_objects = get_experiment_objects(folder)
+        if incomplete_objects:
+            print(f"{len(incomplete_objects)} objects of {experiment} are incomplete:")
+            for object_number, missing_files in sorted(incomplete_objects.items()):
+                print(f"  {object_number} is missing {', '.join(missing_files)}")
 
         for object_number in object_numbers:
-            test_folders = list_sub_directories(f"{preprocessed_folder}/test/")
-            validation_folders = list_sub_directories(f"{preprocessed_folder}/validation")
-            training_folders = list_sub_directories(f"{preprocessed_folder}/training")
-            all_folders = test_folders + validation_folders + training_folders
-
             object_name = f"{experiment}_{object_number}"
-            if object_name in all_folders:
+            if object_name in manifest:
                 continue
 
-            incomplete_object = False
-            for i, ending in zip([1, 2, 3, 4, 11, 10, 8, 0], ['png', 'png', 'png', 'png', 'png', 'png', 'png', 'json']):
-                if not os.path.isfile(f"{folder}/{object_number}__{i}.{ending}"):
-                    incomplete_object = True
-                    break
+            if split_method == 'hash':
+                split = get_hash_split(object_name, split_ratios)
+            else:
+                split = get_balanced_split(split_counts, split_ratios)
+            split_counts[split] += 1
+            pending_objects.append((folder, object_number, object_name, split))
+
+    manifest_file = open(f'{preprocessed_folder}/manifest.jsonl', 'a')
+    if output_mode == 'shards':
+        output = ShardOutput(preprocessed_folder, manifest_file, config.get('shard_size_mb', 1024))
+    elif output_mode == 'tensors':
+        shapes = get_object_shapes(*pending_objects[0][:2]) if pending_objects else {}
+        object_counts = Counter(split for _, _, _, split in pending_objects)
+        output = TensorOutput(preprocessed_folder, manifest_file, shapes, object_counts)
+    else:
+        output = FolderOutput(manifest_file)
+
+    workers = config.get('post_processing_workers', get_cpu_count())
+    max_in_flight = workers * 2
+    tasks = {}
+    finished_count = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for folder, object_number, object_name, split in pending_objects:
+            # keep the number of queued objects bounded
+            if len(tasks) >= max_in_flight:
+                done, _ = wait(tasks, return_when=FIRST_COMPLETED)
+                finished_count = report_finished(done, tasks, finished_count, split_counts, output)
+
+            new_folder = None
+            if output_mode == 'shards':
+                future = executor.submit(encode_object, folder, object_number, image_format)
+            elif output_mode == 'tensors':
+                store_folder, row = output.get_row(split, object_name)
+                future = executor.submit(store_object, folder, object_number, store_folder, row)
+            else:
+                new_folder = f'{preprocessed_folder}/{split}/{object_name}'
+                future = executor.submit(process_object, folder, new_folder, object_number, image_format)
+            tasks[future] = (object_name, split, new_folder)
 
-            if incomplete_object:
-                print(f"Object {object_number} is incomplete")
-                continue
+        finished_count = report_finished(
+            as_completed(list(tasks)), tasks, finished_count, split_counts, output)
 
-            if len(test_folders) < len(all_folders) / 10:
-                new_folder = f'{preprocessed_folder}/test/{object_name}'
-            elif len(validation_folders) < len(all_folders) / 10 * 2:
-                new_folder = f'{preprocessed_folder}/validation/{object_name}'
-            else:
-                new_folder = f'{preprocessed_folder}/training/{object_name}'
-
-            create_folder(new_folder, remove_content=True)
-            copy_image(folder, new_folder, object_number, 1, 'input')
-            copy_image(folder, new_folder, object_number, 2, 'normals')
-            copy_image(folder, new_folder, object_number, 3, 'distance', is_grayscale=True)
-            copy_image(folder, new_folder, object_number, 4, 'mask', is_grayscale=True, new_size=(1024, 1024))
-            create_white_background(folder, new_folder, object_number, 4, 11, 'output_1', 85, 1.4, 1.2)
-            create_white_background(folder, new_folder, object_number, 4, 10, 'output_2', 55, 1.6, 1.15)
-            create_white_background(folder, new_folder, object_number, 4, 8, 'output_3', 35, 1, 1)
-            shutil.copy(f'{folder}/{object_number}__0.json', f'{new_folder}/metadata.json')
+    output.close()
+    manifest_file.close()
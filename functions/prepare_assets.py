@@ -0,0 +1,28 @@
+import os
+import sys
+import json
+from pathlib import Path
+
+# blender does not add the script folder to the python path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from renderer import logging, get_assets_info, define_skip_assets, is_asset_accepted, create_hdri_proxies
+
+
+if __name__ == "__main__":
+
+    assert Path("./config.json").exists(), "config not found. copy config.json to create config_local.json!"
+    with open("./config.json") as f:
+        config = json.load(f)
+
+    assets = get_assets_info(rebuild=True)
+    to_skip = define_skip_assets()
+    accepted_assets = [
+        asset for asset in assets.values()
+        if is_asset_accepted(asset, to_skip, config.get('max_asset_height', 2.6), config.get('max_polygon_count'))
+    ]
+
+    logging.info('Indexed %s assets, %s of them will be rendered', len(assets), len(accepted_assets))
+
+    if config.get('hdri_proxy_folder') is not None:
+        create_hdri_proxies(config['hdri_proxy_folder'], config.get('hdri_proxy_width', 512))
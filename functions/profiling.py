@@ -0,0 +1,91 @@
+import time
+import argparse
+from contextlib import contextmanager
+
+from render_manifest import read_render_manifest
+
+
+class StageTimer:
+    # Sums the wall clock time of named stages of one sample. A stage that runs several times (the exposure loop)
+    # accumulates its time and counts its runs.
+
+    def __init__(self):
+        self.durations = {}
+        self.counts = {}
+
+    @contextmanager
+    def stage(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] = self.durations.get(name, 0) + time.perf_counter() - start_time
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def get_timings(self):
+        timings = {name: round(duration, 4) for name, duration in self.durations.items()}
+        timings['runs'] = {name: count for name, count in self.counts.items() if count > 1}
+        return timings
+
+
+def get_percentile(values, percentile):
+    # linear interpolation between the closest ranks, like numpy.percentile
+    values = sorted(values)
+    position = (len(values) - 1) * percentile / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize_timings(timings):
+    stage_durations = {}
+    for sample_timings in timings:
+        for name, duration in sample_timings.items():
+            if isinstance(duration, (int, float)):
+                stage_durations.setdefault(name, []).append(duration)
+
+    summary = {}
+    for name, durations in stage_durations.items():
+        summary[name] = {
+            'count': len(durations),
+            'total': sum(durations),
+            'mean': sum(durations) / len(durations),
+            'p50': get_percentile(durations, 50),
+            'p95': get_percentile(durations, 95),
+        }
+
+    return summary
+
+
+def format_summary(summary):
+    # stages with the most time first, the total of a sample is not a stage and comes last
+    sample_total = summary.get('total', {}).get('total') or sum(
+        stage['total'] for name, stage in summary.items() if name != 'total')
+
+    lines = [f"{'stage':<24}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'share':>8}"]
+    for name, stage in sorted(summary.items(), key=lambda item: (item[0] == 'total', -item[1]['total'])):
+        share = stage['total'] / sample_total * 100 if sample_total else 0
+        lines.append(
+            f"{name:<24}{stage['count']:>8}{stage['mean']:>10.2f}{stage['p50']:>10.2f}{stage['p95']:>10.2f}"
+            f"{share:>7.1f}%"
+        )
+
+    return '\n'.join(lines)
+
+
+def load_render_timings(experiment_folder):
+    return [record['timings'] for record in read_render_manifest(experiment_folder) if 'timings' in record]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Prints the time per render stage of one or more experiments.")
+    parser.add_argument('experiments', nargs='+', help="experiment folders, e.g. output/experiment_1")
+    arguments = parser.parse_args()
+
+    timings = []
+    for experiment_folder in arguments.experiments:
+        timings += load_render_timings(experiment_folder)
+
+    print(f'{len(timings)} samples')
+    print(format_summary(summarize_timings(timings)))
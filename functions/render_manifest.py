@@ -0,0 +1,20 @@
+import os
+import json
+
+
+def read_render_manifest(experiment_folder):
+    # records of all finished samples, from every manifest_*.jsonl the render workers wrote
+    manifest_folder = f'{experiment_folder}/manifests'
+    records = []
+    for file in sorted(os.listdir(manifest_folder)):
+        if not file.endswith('.jsonl'):
+            continue
+        with open(f'{manifest_folder}/{file}') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # last line of a worker that was killed while writing
+                    continue
+
+    return records
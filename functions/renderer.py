@@ -1,18 +1,30 @@
 import os
 import sys
 import bpy
+import atexit
 import uuid
 import math
 import json
 import time
 import bmesh
 import random
+import hashlib
 import mathutils
 import numpy as np
 from pathlib import Path
+from functools import lru_cache
+from collections import OrderedDict
+from multiprocessing.connection import Client
 from mathutils import Matrix, Vector
 from math import radians, atan2, sqrt, acos, degrees
 
+# blender does not add the script folder to the python path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from hardware import get_cpu_count  # noqa: E402
+from profiling import StageTimer, summarize_timings, format_summary  # noqa: E402
+from render_manifest import read_render_manifest  # noqa: E402
+
 
 class SimpleLogger:
     # Defining log levels
@@ -21,34 +33,81 @@ class SimpleLogger:
     WARNING = 2
     ERROR = 3
     CRITICAL = 4
+    LEVEL_NAMES = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+
+    # Messages are only formatted (msg % args) when their level is enabled. Without an output file every message is
+    # printed as before, with one they are buffered and written as json lines, only warnings and worse are printed.
 
     def __init__(self, level=INFO):
         self.level = level
+        self.file = None
+        self.buffer = []
+        self.buffer_size = 100
+        self.context = {}
+        atexit.register(self.flush)
+
+    def set_level(self, level):
+        self.level = self.LEVEL_NAMES.index(level.upper()) if isinstance(level, str) else level
+
+    def set_output(self, file_path, buffer_size=100, context=None):
+        self.flush()
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        self.file = open(file_path, 'a')
+        self.buffer_size = buffer_size
+        self.context = dict(context or {})
+
+    def debug(self, msg, *args):
+        if self.level <= self.DEBUG:
+            self._log(self.DEBUG, "DEBUG", msg, args)
+
+    def info(self, msg, *args):
+        if self.level <= self.INFO:
+            self._log(self.INFO, "INFO", msg, args)
+
+    def warning(self, msg, *args):
+        if self.level <= self.WARNING:
+            self._log(self.WARNING, "WARNING", msg, args)
+
+    def error(self, msg, *args):
+        if self.level <= self.ERROR:
+            self._log(self.ERROR, "ERROR", msg, args)
+
+    def critical(self, msg, *args):
+        if self.level <= self.CRITICAL:
+            self._log(self.CRITICAL, "CRITICAL", msg, args)
+
+    def _log(self, level, level_name, msg, args=()):
+        if level < self.level:
+            return
+        if args:
+            msg = msg % args
+
+        if self.file is None or level >= self.WARNING:
+            print(f"[{level_name}] {msg}")
+        if self.file is not None:
+            self.buffer.append(json.dumps(dict(self.context, time=time.time(), level=level_name, message=msg)))
+            if len(self.buffer) >= self.buffer_size or level >= self.WARNING:
+                self.flush()
 
-    def debug(self, msg):
-        self._log(self.DEBUG, "DEBUG", msg)
-
-    def info(self, msg):
-        self._log(self.INFO, "INFO", msg)
-
-    def warning(self, msg):
-        self._log(self.WARNING, "WARNING", msg)
+    def flush(self):
+        if self.file is not None and self.buffer:
+            self.file.write('\n'.join(self.buffer) + '\n')
+            self.file.flush()
+            self.buffer.clear()
 
-    def error(self, msg):
-        self._log(self.ERROR, "ERROR", msg)
 
-    def critical(self, msg):
-        self._log(self.CRITICAL, "CRITICAL", msg)
+logging = SimpleLogger(level=SimpleLogger.DEBUG)
 
-    def _log(self, level, level_name, msg):
-        if level >= self.level:
-            print(f"[{level_name}] {msg}")
 
+def remove_datablocks(datablocks, keep=()):
+    for datablock in [datablock for datablock in datablocks if datablock.name not in keep]:
+        datablocks.remove(datablock)
 
-logging = SimpleLogger(level=SimpleLogger.DEBUG)
 
+def remove_old_objects(resident=None):
+    # datablocks listed in resident (e.g. the scene template) survive, everything else is deleted
+    resident = resident or {}
 
-def remove_old_objects():
     # Ensure we're in Object mode
     # bpy.ops.mesh.primitive_cube_add(size=2, location=(0, 0, 0))
     # bpy.ops.object.mode_set(mode='OBJECT')
@@ -56,47 +115,37 @@ def remove_old_objects():
     # # Delete all objects
     # bpy.ops.object.select_all(action='SELECT')
     # bpy.ops.object.delete()
-    while bpy.data.objects:
-        bpy.data.objects.remove(bpy.data.objects[0])
+    remove_datablocks(bpy.data.objects, resident.get('objects', ()))
 
     # Meshes
-    while bpy.data.meshes:
-        bpy.data.meshes.remove(bpy.data.meshes[0])
+    remove_datablocks(bpy.data.meshes, resident.get('meshes', ()))
 
     # Delete all materials
-    while bpy.data.materials:
-        bpy.data.materials.remove(bpy.data.materials[0])
+    remove_datablocks(bpy.data.materials, resident.get('materials', ()))
 
     # Delete all textures
-    while bpy.data.textures:
-        bpy.data.textures.remove(bpy.data.textures[0])
+    remove_datablocks(bpy.data.textures)
 
     # Armatures and Bone Groups
-    while bpy.data.armatures:
-        bpy.data.armatures.remove(bpy.data.armatures[0])
+    remove_datablocks(bpy.data.armatures)
 
     # Particles
-    while bpy.data.particles:
-        bpy.data.particles.remove(bpy.data.particles[0])
+    remove_datablocks(bpy.data.particles)
 
     # Worlds
-    while bpy.data.worlds:
-        bpy.data.worlds.remove(bpy.data.worlds[0])
+    remove_datablocks(bpy.data.worlds, resident.get('worlds', ()))
 
     # Grease Pencils
-    while bpy.data.grease_pencils:
-        bpy.data.grease_pencils.remove(bpy.data.grease_pencils[0])
+    remove_datablocks(bpy.data.grease_pencils)
 
     # Cameras
-    while bpy.data.cameras:
-        bpy.data.cameras.remove(bpy.data.cameras[0])
+    remove_datablocks(bpy.data.cameras)
 
     # Lamps/Lights
-    while bpy.data.lights:
-        bpy.data.lights.remove(bpy.data.lights[0])
+    remove_datablocks(bpy.data.lights)
 
     # Images
-    image_names = [img.name for img in bpy.data.images]
+    image_names = [img.name for img in bpy.data.images if img.name not in resident.get('images', ())]
 
     for image_name in image_names:
         k = 0
@@ -110,9 +159,11 @@ def remove_old_objects():
     logging.debug('ran "remove_old_objects"')
 
 
-def get_assets_info():
-    assets = {}
+ASSET_CATALOG_PATH = "./assets/interior_models/asset_catalog.json"
+ASSET_CATALOG_VERSION = 2
 
+
+def get_asset_bundles():
     blend_files = [
         ("1000_beds_bundle", "beds"),
         ("1000_cabinets_bundle", "cabinets"),
@@ -127,13 +178,91 @@ def get_assets_info():
         ("1000_tablesets_bundle", "tablesets"),
     ]
 
-    for blend_file, category in blend_files:
-        with bpy.data.libraries.load(f"//assets/interior_models/{blend_file}.blend", link=False) as (data_from, _):
-            for value in data_from.objects:
-                assets[value] = {}
-                assets[value]["name"] = value
-                assets[value]["category"] = category
-                assets[value]["file"] = f"{blend_file}.blend"
+    return blend_files
+
+
+def get_file_fingerprint(file_path):
+    stat = os.stat(file_path)
+    return {'mtime': stat.st_mtime, 'size': stat.st_size}
+
+
+def load_asset_catalog(catalog_path=ASSET_CATALOG_PATH):
+    if not os.path.isfile(catalog_path):
+        return {}
+
+    with open(catalog_path) as f:
+        catalog = json.load(f)
+
+    if catalog.get('version') != ASSET_CATALOG_VERSION:
+        return {}
+
+    return catalog['bundles']
+
+
+def save_asset_catalog(bundles, catalog_path=ASSET_CATALOG_PATH):
+    # write to a temporary file first so parallel jobs never read a half written catalog
+    temporary_path = f'{catalog_path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'w') as f:
+        json.dump({'version': ASSET_CATALOG_VERSION, 'bundles': bundles}, f)
+    os.replace(temporary_path, catalog_path)
+
+    logging.debug('ran "save_asset_catalog"')
+
+
+def index_asset_bundle(blend_file, category):
+    with bpy.data.libraries.load(f"//assets/interior_models/{blend_file}.blend", link=False) as (data_from, data_to):
+        object_names = list(data_from.objects)
+        data_to.objects = object_names
+
+    # place the objects like add_asset does, so the sizes match get_asset_size
+    objects = []
+    for object_name, obj in zip(object_names, data_to.objects):
+        if obj is None:
+            continue
+        bpy.context.scene.collection.objects.link(obj)
+        obj.location = (0, 0, 0)
+        obj.rotation_euler = (0, 0, 0)
+        objects.append((object_name, obj))
+
+    assets = {}
+    for object_name, obj in objects:
+        assets[object_name] = {}
+        assets[object_name]["name"] = object_name
+        assets[object_name]["category"] = category
+        assets[object_name]["file"] = f"{blend_file}.blend"
+        assets[object_name]["size"] = get_asset_size(obj.name)
+        assets[object_name]["polygon_count"] = len(obj.data.polygons) if obj.type == 'MESH' else 0
+        assets[object_name]["material_count"] = len(obj.material_slots)
+
+    bpy.data.batch_remove([obj for _, obj in objects])
+    bpy.data.orphans_purge(do_recursive=True)
+
+    logging.debug('ran "index_asset_bundle" for %s', blend_file)
+
+    return assets
+
+
+def get_assets_info(rebuild=False):
+    assets = {}
+
+    cached_bundles = {} if rebuild else load_asset_catalog()
+    bundles = {}
+    for blend_file, category in get_asset_bundles():
+        fingerprint = get_file_fingerprint(f"./assets/interior_models/{blend_file}.blend")
+        cached_bundle = cached_bundles.get(blend_file)
+        if cached_bundle is not None and cached_bundle['fingerprint'] == fingerprint:
+            bundles[blend_file] = cached_bundle
+        else:
+            logging.info('Asset catalog is outdated for %s, indexing it', blend_file)
+            bundles[blend_file] = {
+                'fingerprint': fingerprint,
+                'assets': index_asset_bundle(blend_file, category),
+            }
+
+        assets.update(bundles[blend_file]['assets'])
+
+    if bundles != cached_bundles:
+        save_asset_catalog(bundles)
 
     logging.debug('ran "get_assets_info"')
 
@@ -166,19 +295,20 @@ def add_asset(
     if collection_name in bpy.data.collections:
         collection = bpy.data.collections[collection_name]
     else:
-        logging.CRITICAL('Collection not found!')
+        logging.critical('Collection "%s" not found, linking the asset to the scene collection', collection_name)
+        collection = bpy.context.scene.collection
 
     if object_name in bpy.data.objects:
-        print(f"Object '{object_name}' already exists in the current file.")
+        logging.warning("Object '%s' already exists in the current file.", object_name)
 
     with bpy.data.libraries.load(filepath) as (data_from, data_to):
         if object_name in data_from.objects:
             data_to.objects = [object_name]
         else:
-            print(f"Object '{object_name}' not found in {filepath}")
+            logging.warning("Object '%s' not found in %s", object_name, filepath)
 
     if object_name not in bpy.data.objects:
-        print(f"Failed to append material '{object_name}' from {filepath}")
+        logging.error("Failed to append object '%s' from %s", object_name, filepath)
 
     obj = bpy.data.objects[object_name]
 
@@ -197,14 +327,14 @@ def append_material_from_library(blend_path, material_name):
     # material_path = f"./assets/materials/{blend_path}/{blend_path}/Material/"
     # material_path_dir = f"./assets/materials/{blend_path}/{blend_path}/Material/"
 
-    logging.debug(f'blend_path: "{blend_path}"')
-    logging.debug(f'material_name: "{material_name}"')
+    logging.debug('blend_path: "%s"', blend_path)
+    logging.debug('material_name: "%s"', material_name)
 
     base_assets_path = "//assets/materials/"
     absolute_blend_path = os.path.join(base_assets_path, blend_path, blend_path)
 
     if material_name in bpy.data.materials:
-        print(f"Material '{material_name}' already exists in the current file.")
+        logging.warning("Material '%s' already exists in the current file.", material_name)
 
     # material_directory = os.path.join(base_assets_path, blend_path, blend_path, "Material")
 
@@ -213,10 +343,10 @@ def append_material_from_library(blend_path, material_name):
         if material_name in data_from.materials:
             data_to.materials = [material_name]
         else:
-            print(f"Material '{material_name}' not found in {absolute_blend_path}")
+            logging.warning("Material '%s' not found in %s", material_name, absolute_blend_path)
 
     if material_name not in bpy.data.materials:
-        print(f"Failed to append material '{material_name}' from {absolute_blend_path}")
+        logging.error("Failed to append material '%s' from %s", material_name, absolute_blend_path)
 
     # bpy.ops.wm.append(filename=material_name, directory=material_path)
 
@@ -227,29 +357,112 @@ def append_node_group_from_library(blend_path, node_group_name):
     base_assets_path = "//assets/materials/"
     absolute_blend_path = os.path.join(base_assets_path, blend_path, blend_path)
 
+    # node groups are never removed, so appending them again would only create copies
     if node_group_name in bpy.data.node_groups:
-        print(f"Node group '{node_group_name}' already exists in the current file.")
+        logging.debug("Node group '%s' already exists in the current file.", node_group_name)
+        return
 
     with bpy.data.libraries.load(absolute_blend_path) as (data_from, data_to):
         if node_group_name in data_from.node_groups:
             data_to.node_groups = [node_group_name]
         else:
-            print(f"Node group '{node_group_name}' not found in {absolute_blend_path}")
+            logging.warning("Node group '%s' not found in %s", node_group_name, absolute_blend_path)
 
     if node_group_name not in bpy.data.node_groups:
-        print(f"Failed to append node group '{node_group_name}' from {absolute_blend_path}")
+        logging.error("Failed to append node group '%s' from %s", node_group_name, absolute_blend_path)
 
     logging.debug('ran "append_node_group_from_library"')
 
 
-def add_and_rename_material(materials, material_name='piano_key'):
+def get_surface_link(material):
+    # node and socket that feed the surface input of the material output
+    if not material.use_nodes:
+        return None
+    for link in material.node_tree.links:
+        if link.to_node.type == 'OUTPUT_MATERIAL' and link.to_socket.name == 'Surface':
+            return link.from_node.name, link.from_socket.name
+    return None
+
+
+# Keeps appended library materials (and their textures) loaded between samples. Materials are handed out as copies,
+# so the cached original is never modified. The least recently used materials are removed once the estimated size of
+# their images exceeds the memory budget.
+class MaterialCache:
+    def __init__(self, budget_mb):
+        self.budget = budget_mb * 1024 * 1024
+        self.entries = OrderedDict()
+        self.surface_links = {}
+
+    def add_material(self, material, new_material_name):
+        cached_material_name = self.entries.get(material['name'])
+        if cached_material_name is not None and cached_material_name in bpy.data.materials:
+            # the originals are copied for every sample and must never be rewired by the render passes
+            cached_material = bpy.data.materials[cached_material_name]
+            if get_surface_link(cached_material) != self.surface_links.get(cached_material_name):
+                logging.error('cached material "%s" was modified, loading it again', cached_material_name)
+                bpy.data.materials.remove(cached_material)
+
+        if cached_material_name is None or cached_material_name not in bpy.data.materials:
+            append_material_from_library(material['file'], material['name'])
+            cached_material_name = f'cached_{material["name"]}'
+            bpy.data.materials[material['name']].name = cached_material_name
+            self.entries[material['name']] = cached_material_name
+            self.surface_links[cached_material_name] = get_surface_link(bpy.data.materials[cached_material_name])
+            logging.debug('material cache miss for "%s"', material['name'])
+
+        self.entries.move_to_end(material['name'])
+        bpy.data.materials[cached_material_name].copy().name = new_material_name
+        self.evict()
+
+    def get_images(self, material_name):
+        material = bpy.data.materials[material_name]
+        if not material.use_nodes:
+            return set()
+        return get_node_tree_images(material.node_tree)
+
+    def get_size(self):
+        images = set()
+        for cached_material_name in self.entries.values():
+            if cached_material_name in bpy.data.materials:
+                images |= self.get_images(cached_material_name)
+
+        size = 0
+        for image_name in images:
+            image = bpy.data.images[image_name]
+            size += image.size[0] * image.size[1] * image.channels * (4 if image.is_float else 1)
+
+        return size
+
+    def evict(self):
+        # the most recently used material always stays, even if it alone exceeds the budget
+        while len(self.entries) > 1 and self.get_size() > self.budget:
+            _, cached_material_name = self.entries.popitem(last=False)
+            if cached_material_name in bpy.data.materials:
+                bpy.data.materials.remove(bpy.data.materials[cached_material_name])
+            self.surface_links.pop(cached_material_name, None)
+            logging.debug('evicted "%s" from the material cache', cached_material_name)
+
+    def get_resident(self):
+        resident = {'materials': set(), 'images': set()}
+        for cached_material_name in self.entries.values():
+            if cached_material_name in bpy.data.materials:
+                resident['materials'].add(cached_material_name)
+                resident['images'] |= self.get_images(cached_material_name)
+
+        return resident
+
+
+def add_and_rename_material(materials, material_name='piano_key', material_cache=None):
     logging.debug('started "add_and_rename_material" function.')
     material = materials[material_name]
     new_material_name = f'{material["name"]}_{uuid.uuid4().int}'
-    append_material_from_library(material['file'], material['name'])
-    bpy.data.materials[material['name']].name = new_material_name
+    if material_cache is not None:
+        material_cache.add_material(material, new_material_name)
+    else:
+        append_material_from_library(material['file'], material['name'])
+        bpy.data.materials[material['name']].name = new_material_name
 
-    logging.debug(f'ran "add_and_rename_material" and added material {new_material_name}')
+    logging.debug('ran "add_and_rename_material" and added material %s', new_material_name)
 
     return new_material_name
 
@@ -443,9 +656,14 @@ def get_materials_info():
     return materials
 
 
-def get_random_hdri(randomness=True):
+@lru_cache(maxsize=None)
+def get_hdri_files():
     files = os.listdir("./assets/background/")
-    exr_files = [f for f in files if f.endswith(".exr")]
+    return tuple(f for f in files if f.endswith(".exr"))
+
+
+def get_random_hdri(randomness=True):
+    exr_files = get_hdri_files()
     assert len(exr_files) > 0, "Should have .exr files in background directory"
 
     if randomness:
@@ -522,7 +740,8 @@ def create_plane(dead_axis, dead_coord, bottom_left, top_right, material_name):
     logging.debug('ran "create_plane"')
 
 
-def create_texture_plane(dead_axis, dead_coord, bottom_left, top_right, flip, material, has_texture=True):
+def create_texture_plane(
+        dead_axis, dead_coord, bottom_left, top_right, flip, material, has_texture=True, material_cache=None):
     coords = convert_coords(dead_axis, dead_coord, bottom_left, top_right)
 
     # create names
@@ -571,8 +790,11 @@ def create_texture_plane(dead_axis, dead_coord, bottom_left, top_right, flip, ma
     mod_subsurf.render_levels = 10
 
     # add material from library
-    append_material_from_library(material['file'], material['name'])
-    bpy.data.materials[material['name']].name = material_name
+    if material_cache is not None:
+        material_cache.add_material(material, material_name)
+    else:
+        append_material_from_library(material['file'], material['name'])
+        bpy.data.materials[material['name']].name = material_name
     assign_material_to_object(obj_name, material_name)
 
     if has_texture:
@@ -585,11 +807,103 @@ def create_texture_plane(dead_axis, dead_coord, bottom_left, top_right, flip, ma
     logging.debug('ran "create_texture_plane"')
 
 
-def add_world_background(exr_file_path, strength=1.0, rotation_degrees=0.0, randomness=False):
+def create_world_nodes(node_tree):
+    # clear out existing nodes
+    node_tree.nodes.clear()
+
+    # Create new Environment Texture node
+    environment_texture_node = node_tree.nodes.new(type='ShaderNodeTexEnvironment')
+    environment_texture_node.name = 'Background Environment'
+
+    # Create a Background node
+    background_node = node_tree.nodes.new(type='ShaderNodeBackground')
+    background_node.name = 'Background'
+
+    # Create mapping and texture coordinate nodes for controlling rotation
+    tex_coord_node = node_tree.nodes.new(type='ShaderNodeTexCoord')
+    mapping_node = node_tree.nodes.new(type='ShaderNodeMapping')
+    mapping_node.name = 'Background Mapping'
+
+    # Connect nodes
+    node_tree.links.new(tex_coord_node.outputs["Generated"], mapping_node.inputs["Vector"])
+    node_tree.links.new(mapping_node.outputs["Vector"], environment_texture_node.inputs["Vector"])
+    node_tree.links.new(environment_texture_node.outputs["Color"], background_node.inputs["Color"])
+
+    # Create and connect the World Output node
+    world_output_node = node_tree.nodes.new(type='ShaderNodeOutputWorld')
+    node_tree.links.new(background_node.outputs["Background"], world_output_node.inputs["Surface"])
+
+    logging.debug('ran "create_world_nodes"')
+
+
+# Keeps loaded environment images between samples. Optionally serves lower resolution proxies with the same file
+# name from proxy_folder (see create_hdri_proxies) for passes where the background barely matters.
+class HdriCache:
+    def __init__(self, max_images, proxy_folder=None):
+        self.max_images = max_images
+        self.proxy_folder = proxy_folder
+        self.entries = OrderedDict()
+
+    def get_image(self, exr_file_path, proxy=False):
+        if proxy and self.proxy_folder is not None:
+            proxy_file_path = os.path.join(self.proxy_folder, os.path.basename(exr_file_path))
+            if os.path.isfile(bpy.path.abspath(proxy_file_path)):
+                exr_file_path = proxy_file_path
+
+        image_name = self.entries.get(exr_file_path)
+        if image_name is None or image_name not in bpy.data.images:
+            image = bpy.data.images.load(exr_file_path)
+            self.entries[exr_file_path] = image.name
+            logging.debug('hdri cache miss for "%s"', exr_file_path)
+
+        self.entries.move_to_end(exr_file_path)
+        image = bpy.data.images[self.entries[exr_file_path]]
+        self.evict()
+
+        return image
+
+    def evict(self):
+        # the most recently used image is always kept, it is about to be used by the world
+        while len(self.entries) > max(self.max_images, 1):
+            _, image_name = self.entries.popitem(last=False)
+            if image_name in bpy.data.images:
+                image = bpy.data.images[image_name]
+                image.user_clear()
+                bpy.data.images.remove(image)
+            logging.debug('evicted "%s" from the hdri cache', image_name)
+
+    def get_resident(self):
+        return {'images': {image_name for image_name in self.entries.values() if image_name in bpy.data.images}}
+
+
+def create_hdri_proxies(proxy_folder, width=512):
+    os.makedirs(bpy.path.abspath(proxy_folder), exist_ok=True)
+
+    for exr_file in get_hdri_files():
+        proxy_file_path = os.path.join(proxy_folder, exr_file)
+        if os.path.isfile(bpy.path.abspath(proxy_file_path)):
+            continue
+
+        image = bpy.data.images.load(f"//assets/background/{exr_file}")
+        image.scale(width, max(round(width * image.size[1] / image.size[0]), 1))
+        image.filepath_raw = proxy_file_path
+        image.file_format = 'OPEN_EXR'
+        image.save()
+        bpy.data.images.remove(image)
+        logging.info('created hdri proxy %s', proxy_file_path)
+
+    logging.debug('ran "create_hdri_proxies"')
+
+
+def add_world_background(
+        exr_file_path, strength=1.0, rotation_degrees=0.0, randomness=False, hdri_cache=None, proxy=False):
     rotation_degrees = random.random() * 360 if randomness else rotation_degrees
 
     # Load the image into Blender
-    image = bpy.data.images.load(exr_file_path)
+    if hdri_cache is not None:
+        image = hdri_cache.get_image(exr_file_path, proxy)
+    else:
+        image = bpy.data.images.load(exr_file_path, check_existing=True)
 
     # Check if the image is loaded correctly
     if not image:
@@ -604,36 +918,18 @@ def add_world_background(exr_file_path, strength=1.0, rotation_degrees=0.0, rand
     # Ensure the world uses nodes
     scene.world.use_nodes = True
 
-    # Get the node tree of the world and clear out existing nodes
+    # Reuse the nodes of a previous call, otherwise build them
     node_tree = scene.world.node_tree
-    node_tree.nodes.clear()
-
-    # Create new Environment Texture node
-    environment_texture_node = node_tree.nodes.new(type='ShaderNodeTexEnvironment')
-    environment_texture_node.image = image
-
-    # Create a Background node
-    background_node = node_tree.nodes.new(type='ShaderNodeBackground')
-    background_node.inputs[1].default_value = strength
+    if 'Background Environment' not in node_tree.nodes:
+        create_world_nodes(node_tree)
 
-    # Create mapping and texture coordinate nodes for controlling rotation
-    tex_coord_node = node_tree.nodes.new(type='ShaderNodeTexCoord')
-    mapping_node = node_tree.nodes.new(type='ShaderNodeMapping')
+    node_tree.nodes['Background Environment'].image = image
 
     # Set the rotation in Z axis
-    mapping_node.inputs["Rotation"].default_value[2] = radians(rotation_degrees)
-
-    # Connect nodes
-    node_tree.links.new(tex_coord_node.outputs["Generated"], mapping_node.inputs["Vector"])
-    node_tree.links.new(mapping_node.outputs["Vector"], environment_texture_node.inputs["Vector"])
-    node_tree.links.new(environment_texture_node.outputs["Color"], background_node.inputs["Color"])
-
-    # Create and connect the World Output node
-    world_output_node = node_tree.nodes.new(type='ShaderNodeOutputWorld')
-    node_tree.links.new(background_node.outputs["Background"], world_output_node.inputs["Surface"])
+    node_tree.nodes['Background Mapping'].inputs["Rotation"].default_value[2] = radians(rotation_degrees)
 
     # add strength
-    background_node.inputs[1].default_value = strength
+    node_tree.nodes['Background'].inputs[1].default_value = strength
 
     logging.debug('ran "add_world_background"')
 
@@ -659,7 +955,41 @@ def get_asset_size(obj_name):
     return (max_x - min_x, max_y - min_y, max_z - min_z)
 
 
-def customize_render_quality(show_background=False, high_quality=True, image_size=1024):
+def select_render_device(device='AUTO', compute_device_type='CUDA', threads=None, cpu_tile_size=256):
+    scene = bpy.data.scenes['Scene']
+    preferences = bpy.context.preferences.addons['cycles'].preferences
+
+    gpu_devices = []
+    if device in ['AUTO', 'GPU']:
+        preferences.compute_device_type = compute_device_type
+        devices = preferences.get_devices_for_type(compute_device_type)
+        gpu_devices = [d for d in devices if d.type == compute_device_type]
+        if not gpu_devices:
+            logging.warning('No %s device found, rendering on the CPU', compute_device_type)
+
+    if gpu_devices:
+        scene.cycles.device = 'GPU'
+        for gpu_device in gpu_devices:
+            gpu_device.use = True
+            logging.debug("%s device %s", compute_device_type, gpu_device.name)
+        return 'GPU'
+
+    # use every core slurm gave us and a BVH that is slower to build but faster to trace on the CPU
+    preferences.compute_device_type = 'NONE'
+    scene.cycles.device = 'CPU'
+    scene.render.threads_mode = 'FIXED'
+    scene.render.threads = threads or get_cpu_count()
+    scene.cycles.tile_size = cpu_tile_size
+    scene.cycles.debug_use_spatial_splits = True
+    scene.render.use_persistent_data = True
+    logging.info('Rendering on the CPU with %s threads', scene.render.threads)
+
+    return 'CPU'
+
+
+def customize_render_quality(
+        show_background=False, high_quality=True, image_size=1024, device='AUTO', compute_device_type='CUDA',
+        threads=None, cpu_tile_size=256):
     if 'Scene' not in bpy.data.scenes:
         logging.critical('Error! No scene named "Scene". Error happened in customize_render_quality()')
     bpy.data.scenes['Scene'].render.resolution_x = image_size
@@ -667,13 +997,7 @@ def customize_render_quality(show_background=False, high_quality=True, image_siz
 
     if high_quality:
         bpy.data.scenes['Scene'].render.engine = 'CYCLES'
-        bpy.data.scenes['Scene'].cycles.device = 'GPU'
-        bpy.context.preferences.addons['cycles'].preferences.compute_device_type = 'CUDA'
-        for device in bpy.context.preferences.addons['cycles'].preferences.get_devices_for_type('CUDA'):
-            if device.type == 'CUDA':
-                device.use = True
-                logging.debug(f"CUDA device {device.name}")
-        bpy.ops.wm.save_userpref()
+        select_render_device(device, compute_device_type, threads, cpu_tile_size)
         bpy.data.scenes['Scene'].cycles.adaptive_threshold = 0.1
     else:
         bpy.data.scenes['Scene'].render.engine = 'BLENDER_EEVEE'
@@ -714,6 +1038,53 @@ def customize_render_quality(show_background=False, high_quality=True, image_siz
     logging.debug('ran "customize_render_quality"')
 
 
+render_profiles = {}
+
+
+def get_render_profile_fields():
+    return [
+        'samples', 'use_adaptive_sampling', 'adaptive_threshold', 'use_denoising', 'denoiser', 'max_bounces',
+        'diffuse_bounces', 'glossy_bounces', 'transmission_bounces', 'volume_bounces', 'transparent_max_bounces',
+        'tile_size',
+    ]
+
+
+def setup_render_profiles(config):
+    # the beauty profile is the scene as set up by customize_render_quality, the others derive from it
+    beauty = {field: getattr(bpy.context.scene.cycles, field) for field in get_render_profile_fields()}
+
+    profiles = {
+        'beauty': beauty,
+        'backdrop': dict(beauty),
+        # normals and distance are emission only, they need no light bounces and no denoising
+        'data': dict(beauty, samples=16, use_denoising=False, max_bounces=0, diffuse_bounces=0, glossy_bounces=0,
+                     transmission_bounces=0, volume_bounces=0, transparent_max_bounces=0),
+        'preview': dict(beauty, samples=config.get('exposure_preview_samples', 16), use_denoising=False),
+    }
+
+    # the mask only separates the black object from the plane, the data profile samples are enough for antialiasing
+    profiles['mask'] = dict(profiles['data'])
+
+    for name, settings in config.get('render_profiles', {}).items():
+        profiles[name] = dict(profiles.get(name, beauty), **settings)
+
+    render_profiles.clear()
+    render_profiles.update(profiles)
+
+    logging.debug('ran "setup_render_profiles"')
+
+
+def apply_render_profile(name):
+    scene = bpy.context.scene
+    if scene.render.engine != 'CYCLES' or name not in render_profiles:
+        return
+
+    for field, value in render_profiles[name].items():
+        setattr(scene.cycles, field, value)
+
+    logging.debug('applied render profile "%s"', name)
+
+
 def customize_render_resolution(image_size):
     if 'Scene' not in bpy.data.scenes:
         logging.critical('Error! No scene named "Scene". Error happened in customize_render_resolution()')
@@ -752,7 +1123,7 @@ def rotate_object_around_point(object_name, point=(0, 0, 0), rotation=45):
         current_mat = obj.matrix_world
         obj.matrix_world = to_point_mat @ rot_mat @ to_origin_mat @ current_mat
     else:
-        logging.warning(f"Object named {object_name} does not exist in the current scene.")
+        logging.warning("Object named %s does not exist in the current scene.", object_name)
 
     logging.debug('ran "rotate_object_around_point"')
 
@@ -782,7 +1153,7 @@ def add_camera(asset_size, randomness=True):
         (abs(y_camera) - (y / 2), z_camera)
     )
     fov_angle = max(z_fov_angle, x_fov_angle)
-    logging.info(f'fov angles: {z_fov_angle} {x_fov_angle}')
+    logging.info('fov angles: %s %s', z_fov_angle, x_fov_angle)
 
     if 'Camera' not in bpy.data.cameras:
         logging.critical('Error! No camera named "Camera". Error happened in add_camera()')
@@ -803,7 +1174,7 @@ def add_camera(asset_size, randomness=True):
 
     rotate_object_around_point("ProductCamera", rotation=camera_rotation)
     camera_position = tuple(cam_object.location)
-    logging.info(f'cam position and angle: {camera_position} {angle}')
+    logging.info('cam position and angle: %s %s', camera_position, angle)
 
     logging.debug('ran "add_camera"')
 
@@ -843,11 +1214,14 @@ def add_point_lights(asset_size):
     logging.debug('ran "add_point_lights"')
 
 
-def take_picture(folder, image_name):
+def take_picture(folder, image_name, render_profile=None):
     folder_path = f'./output/{folder}'
     if not os.path.exists(folder_path):
         os.makedirs(folder_path)
 
+    if render_profile is not None:
+        apply_render_profile(render_profile)
+
     bpy.context.scene.render.filepath = f'//output/{folder}/{image_name}.png'
     bpy.ops.render.render(write_still=True)
 
@@ -877,6 +1251,20 @@ def define_skip_assets():
     return to_skip
 
 
+def is_asset_accepted(asset, to_skip, max_height=2.6, max_polygon_count=None):
+    # uses the asset catalog, so rejected assets are never loaded into the scene
+    if asset['name'] in to_skip:
+        return False
+
+    if asset['size'][2] > max_height:
+        return False
+
+    if max_polygon_count is not None and asset['polygon_count'] > max_polygon_count:
+        return False
+
+    return True
+
+
 def create_window_wall(
         dead_axis, dead_coord, left, right, z_top, flip, wall_material_name, window_material_name, glass_material_name,
         overlap, randomness):
@@ -900,8 +1288,10 @@ def create_window_wall(
     above_window = 0.1 + above_window_random * 0.4
     window_border = 0.03 + 0.05 * window_border_random
 
-    logging.info(f'wall: {dead_axis} {round(dead_coord, 2)} / width: {round(wall_width, 2)}, windows: {windows} \
-border space: {round(border_space, 2)}')
+    logging.info(
+        'wall: %s %s / width: %s, windows: %s border space: %s',
+        dead_axis, round(dead_coord, 2), round(wall_width, 2), windows, round(border_space, 2)
+    )
 
     # border before first and after last window
     create_plane(
@@ -1028,7 +1418,7 @@ border space: {round(border_space, 2)}')
     logging.debug('ran "create_window_wall"')
 
 
-def create_room(asset_size, camera_position, materials, hdri_name, randomness=True):
+def create_room(asset_size, camera_position, materials, hdri_name, randomness=True, material_cache=None):
     x_left_random = random.random() if randomness else 0.5
     x_right_random = random.random() if randomness else 0.5
     y_behind_random = random.random() if randomness else 0.5
@@ -1056,7 +1446,7 @@ def create_room(asset_size, camera_position, materials, hdri_name, randomness=Tr
     depth = round(y_behind - y_front, 2)
     height = round(z_top, 2)
 
-    logging.info(f'Room size: width = {width}, depth = {depth}, height = {height}')
+    logging.info('Room size: width = %s, depth = %s, height = %s', width, depth, height)
 
     overlap = 0.1
 
@@ -1073,7 +1463,8 @@ def create_room(asset_size, camera_position, materials, hdri_name, randomness=Tr
         (x_left - overlap, y_front - overlap),
         (x_right + overlap, y_behind + overlap),
         False,
-        floor_material
+        floor_material,
+        material_cache=material_cache
     )
 
     # ceiling
@@ -1089,7 +1480,8 @@ def create_room(asset_size, camera_position, materials, hdri_name, randomness=Tr
         (x_left - overlap, y_front - overlap),
         (x_right + overlap, y_behind + overlap),
         True,
-        ceiling_material
+        ceiling_material,
+        material_cache=material_cache
     )
 
     # light
@@ -1124,13 +1516,14 @@ def create_room(asset_size, camera_position, materials, hdri_name, randomness=Tr
         (x_left - overlap, 0 - overlap),
         (x_right + overlap, z_top + overlap),
         False,
-        wall_material
+        wall_material,
+        material_cache=material_cache
     )
 
     # other walls
-    wall_material_name = add_and_rename_material(materials, 'sy_white_matte')
-    window_material_name = add_and_rename_material(materials, 'sy_lite_shiny')
-    glass_material_name = add_and_rename_material(materials, 'window')
+    wall_material_name = add_and_rename_material(materials, 'sy_white_matte', material_cache)
+    window_material_name = add_and_rename_material(materials, 'sy_lite_shiny', material_cache)
+    glass_material_name = add_and_rename_material(materials, 'window', material_cache)
 
     for dead_axis, dead_coord, left, right, flip in zip(
         ['x', 'x', 'y'],
@@ -1188,7 +1581,7 @@ def add_node_group_to_material(material, node_group_name, output_socket_name):
     node_group = bpy.data.node_groups.get(node_group_name)
 
     if node_group is None:
-        print("Node group not found!")
+        logging.error('Node group "%s" not found!', node_group_name)
 
     uses_nodes = material.use_nodes
     if not material.use_nodes:
@@ -1215,15 +1608,15 @@ def add_node_group_to_material(material, node_group_name, output_socket_name):
     return previous_node, previous_socket_name, output_node, uses_nodes
 
 
-def add_node_group_to_all_materials(node_group_name, output_socket_name):
+def add_node_group_to_all_materials(node_group_name, output_socket_name, skip_materials=()):
     for material in bpy.data.materials:
-        if material.use_nodes:
+        if material.use_nodes and material.name not in skip_materials:
             add_node_group_to_material(material, node_group_name, output_socket_name)
 
 
 def save_metadata(
         folder, file_name, asset, camera_position, camera_rotation, distance, hdri_name, time_difference, brightness,
-        f_stop, room_metadata):
+        f_stop, room_metadata, hdri_strength=None, image_profiles=None, image_sources=None):
 
     folder_path = f'./output/{folder}'
     if not os.path.exists(folder_path):
@@ -1238,110 +1631,759 @@ def save_metadata(
         'hdri_name': hdri_name,
         'time_to_compute': time_difference,
         'brightness': brightness,
+        'hdri_strength': hdri_strength,
         'f_stop': f_stop,
         'room_metadata': room_metadata,
+        'render_profiles': {
+            str(image_number): dict(render_profiles.get(name, {}), name=name)
+            for image_number, name in (image_profiles or {}).items()
+        },
+        'image_sources': {str(image_number): source for image_number, source in (image_sources or {}).items()},
     }
-    with open(file_path, 'w') as outfile:
+    # written under a temporary name first, a crash never leaves a half written metadata file
+    with open(f'{file_path}.tmp', 'w') as outfile:
         json.dump(metadata, outfile)
+    os.replace(f'{file_path}.tmp', file_path)
 
     logging.debug('ran "save_metadata"')
 
 
+def setup_compositor():
+    scene = bpy.context.scene
+    scene.use_nodes = True
+    scene.render.use_compositing = True
+    node_tree = scene.node_tree
+
+    render_layers_node = select_node_by_type(node_tree, 'R_LAYERS')
+    if render_layers_node is None:
+        render_layers_node = node_tree.nodes.new(type='CompositorNodeRLayers')
+
+    composite_node = select_node_by_type(node_tree, 'COMPOSITE')
+    if composite_node is None:
+        composite_node = node_tree.nodes.new(type='CompositorNodeComposite')
+    node_tree.links.new(render_layers_node.outputs["Image"], composite_node.inputs["Image"])
+
+    # the viewer node keeps the last render in memory, so its brightness can be read without loading the png
+    viewer_node = select_node_by_type(node_tree, 'VIEWER')
+    if viewer_node is None:
+        viewer_node = node_tree.nodes.new(type='CompositorNodeViewer')
+    viewer_input = setup_viewer_display_transform(node_tree, render_layers_node.outputs["Image"])
+    node_tree.links.new(viewer_input, viewer_node.inputs["Image"])
+
+    logging.debug('ran "setup_compositor"')
+
+
+def get_display_color_space():
+    # color space of the OCIO config that encodes scene linear values like the view transform does for the saved png
+    scene = bpy.context.scene
+    if (scene.view_settings.look != 'None' or scene.view_settings.use_curve_mapping
+            or scene.display_settings.display_device != 'sRGB'):
+        return None
+    return {'Standard': 'sRGB', 'Filmic': 'Filmic sRGB', 'AgX': 'AgX Base sRGB'}.get(scene.view_settings.view_transform)
+
+
+def setup_viewer_display_transform(node_tree, image_socket):
+    # applies the exposure and the view transform in the compositor, so the viewer holds display encoded values like
+    # the png (only the gamma is left). Returns the socket the viewer reads from
+    if 'Viewer Display Transform' in node_tree.nodes:
+        return node_tree.nodes['Viewer Display Transform'].outputs["Image"]
+
+    display_color_space = get_display_color_space()
+    if display_color_space is None:
+        logging.warning('No display color space for the view transform, brightness is measured on the saved png')
+        return image_socket
+
+    convert_node = node_tree.nodes.new(type='CompositorNodeConvertColorSpace')
+    color_spaces = [item.identifier for item in convert_node.bl_rna.properties['to_color_space'].enum_items]
+    linear_color_space = next((name for name in ['Linear Rec.709', 'Linear'] if name in color_spaces), None)
+    if display_color_space not in color_spaces or linear_color_space is None:
+        node_tree.nodes.remove(convert_node)
+        logging.warning('Color space "%s" not found, brightness is measured on the saved png', display_color_space)
+        return image_socket
+
+    convert_node.name = 'Viewer Display Transform'
+    convert_node.from_color_space = linear_color_space
+    convert_node.to_color_space = display_color_space
+
+    exposure_node = node_tree.nodes.new(type='CompositorNodeExposure')
+    exposure_node.name = 'Viewer Exposure'
+    exposure_node.inputs["Exposure"].default_value = bpy.context.scene.view_settings.exposure
+
+    node_tree.links.new(image_socket, exposure_node.inputs["Image"])
+    node_tree.links.new(exposure_node.outputs["Image"], convert_node.inputs["Image"])
+
+    return convert_node.outputs["Image"]
+
+
+pass_image_numbers = []
+# the conventions the normals and distance passes can be written in. The first sample of a run renders the node groups
+# as well and keeps the convention that matches them (verify_pass_outputs), None if no convention matches
+pass_conventions = {2: ['world', 'camera', 'camera_z_forward'], 3: ['planar', 'radial']}
+verified_conventions = {}
+# the camera space of blender looks down -z, the camera space of cycles (and its vector transform node) looks down +z
+camera_z_signs = {'camera': 1, 'camera_z_forward': -1}
+
+
+def add_normal_nodes(node_tree, normal_socket, convention):
+    # normals from -1..1 to 0..1. The normal pass is in world space, the camera conventions rotate it with the camera
+    # rotation of the sample, which enable_pass_outputs writes into the "Pass 2 <convention> <row><column>" nodes
+    separate_node = node_tree.nodes.new(type='CompositorNodeSeparateColor')
+    combine_node = node_tree.nodes.new(type='CompositorNodeCombineColor')
+    combine_node.name = f'Pass 2 {convention}'
+    node_tree.links.new(normal_socket, separate_node.inputs["Image"])
+    channels = ["Red", "Green", "Blue"]
+    for row, channel in enumerate(channels):
+        value_socket = separate_node.outputs[channel]
+        if convention in camera_z_signs:
+            value_socket = None
+            for column, column_channel in enumerate(channels):
+                rotation_node = node_tree.nodes.new(type='CompositorNodeMath')
+                rotation_node.name = f'Pass 2 {convention} {row}{column}'
+                rotation_node.operation = 'MULTIPLY' if value_socket is None else 'MULTIPLY_ADD'
+                node_tree.links.new(separate_node.outputs[column_channel], rotation_node.inputs[0])
+                if value_socket is not None:
+                    node_tree.links.new(value_socket, rotation_node.inputs[2])
+                value_socket = rotation_node.outputs["Value"]
+
+        math_node = node_tree.nodes.new(type='CompositorNodeMath')
+        math_node.operation = 'MULTIPLY_ADD'
+        math_node.inputs[1].default_value = 0.5
+        math_node.inputs[2].default_value = 0.5
+        node_tree.links.new(value_socket, math_node.inputs[0])
+        node_tree.links.new(math_node.outputs["Value"], combine_node.inputs[channel])
+
+    logging.debug('ran "add_normal_nodes"')
+
+
+def add_distance_nodes(node_tree, render_layers_node, convention):
+    # distance, mapped to the same range as the "Map Range" node of the get_distance node group (0 to twice the
+    # camera distance). The depth pass is the planar distance along the view axis, the radial distance is the length
+    # from the camera location (written into the "Pass 3 radial <axis>" nodes per sample) to the position pass
+    map_range_node = node_tree.nodes.new(type='CompositorNodeMapRange')
+    map_range_node.name = f'Pass 3 {convention}'
+    map_range_node.use_clamp = True
+    if convention == 'planar':
+        node_tree.links.new(render_layers_node.outputs["Depth"], map_range_node.inputs["Value"])
+        logging.debug('ran "add_distance_nodes"')
+        return
+
+    separate_node = node_tree.nodes.new(type='CompositorNodeSeparateColor')
+    node_tree.links.new(render_layers_node.outputs["Position"], separate_node.inputs["Image"])
+    squared_socket = None
+    for axis, channel in enumerate(["Red", "Green", "Blue"]):
+        offset_node = node_tree.nodes.new(type='CompositorNodeMath')
+        offset_node.name = f'Pass 3 {convention} {axis}'
+        offset_node.operation = 'SUBTRACT'
+        node_tree.links.new(separate_node.outputs[channel], offset_node.inputs[0])
+
+        square_node = node_tree.nodes.new(type='CompositorNodeMath')
+        square_node.operation = 'MULTIPLY' if squared_socket is None else 'MULTIPLY_ADD'
+        node_tree.links.new(offset_node.outputs["Value"], square_node.inputs[0])
+        node_tree.links.new(offset_node.outputs["Value"], square_node.inputs[1])
+        if squared_socket is not None:
+            node_tree.links.new(squared_socket, square_node.inputs[2])
+        squared_socket = square_node.outputs["Value"]
+
+    root_node = node_tree.nodes.new(type='CompositorNodeMath')
+    root_node.operation = 'SQRT'
+    node_tree.links.new(squared_socket, root_node.inputs[0])
+    node_tree.links.new(root_node.outputs["Value"], map_range_node.inputs["Value"])
+
+    logging.debug('ran "add_distance_nodes"')
+
+
+def setup_pass_outputs(normals_and_distance=True, object_mask=False):
+    # data images are written from the render passes of the beauty render by a file output node
+    node_tree = bpy.context.scene.node_tree
+    if 'Pass Output' in node_tree.nodes:
+        return
+
+    view_layer = bpy.context.view_layer
+    render_layers_node = select_node_by_type(node_tree, 'R_LAYERS')
+
+    output_node = node_tree.nodes.new(type='CompositorNodeOutputFile')
+    output_node.name = 'Pass Output'
+    output_node.format.file_format = 'PNG'
+    output_node.format.color_mode = 'RGB'
+    output_node.format.color_depth = '8'
+    output_node.file_slots.clear()
+    output_node.mute = True
+
+    if normals_and_distance:
+        view_layer.use_pass_normal = True
+        view_layer.use_pass_z = True
+        view_layer.use_pass_position = True
+
+        for convention in pass_conventions[2]:
+            add_normal_nodes(node_tree, render_layers_node.outputs["Normal"], convention)
+        for convention in pass_conventions[3]:
+            add_distance_nodes(node_tree, render_layers_node, convention)
+
+        # until the first sample verified them, the outputs are linked to the first convention
+        for image_number, slot_name in [(2, "normals"), (3, "distance")]:
+            output_node.file_slots.new(slot_name)
+            node_tree.links.new(get_pass_node(image_number, pass_conventions[image_number][0]).outputs[0],
+                                output_node.inputs[-1])
+            pass_image_numbers.append(image_number)
+
+    if object_mask:
+        # the product has pass index 1. Like the pitch black mask, the background is white and the product black
+        view_layer.use_pass_object_index = True
+
+        id_mask_node = node_tree.nodes.new(type='CompositorNodeIDMask')
+        id_mask_node.index = 1
+        id_mask_node.use_antialiasing = True
+        node_tree.links.new(render_layers_node.outputs["IndexOB"], id_mask_node.inputs["ID value"])
+
+        invert_node = node_tree.nodes.new(type='CompositorNodeMath')
+        invert_node.operation = 'SUBTRACT'
+        invert_node.inputs[0].default_value = 1
+        node_tree.links.new(id_mask_node.outputs["Alpha"], invert_node.inputs[1])
+
+        output_node.file_slots.new("mask")
+        node_tree.links.new(invert_node.outputs["Value"], output_node.inputs[-1])
+        pass_image_numbers.append(4)
+
+    # normals and distance go through the view transform like the emission renders of the node groups, the mask is
+    # object coverage and is written as is
+    for file_slot in output_node.file_slots:
+        file_slot.save_as_render = file_slot.path != 'mask'
+
+    logging.debug('ran "setup_pass_outputs"')
+
+
+def get_pass_node(image_number, convention):
+    return bpy.context.scene.node_tree.nodes[f'Pass {image_number} {convention}']
+
+
+def enable_pass_outputs(folder, sample_number, distance):
+    node_tree = bpy.context.scene.node_tree
+    output_node = node_tree.nodes['Pass Output']
+    output_node.base_path = f'//output/{folder}/'
+    for file_slot, image_number in zip(output_node.file_slots, pass_image_numbers):
+        file_slot.path = f'{sample_number}__{image_number}_'
+
+    if 'Pass 3 planar' in node_tree.nodes:
+        bpy.context.view_layer.update()
+        camera = bpy.context.scene.camera
+        # world to camera rotation, the camera matrix is orthonormal so the transpose is the inverse
+        camera_rotation = camera.matrix_world.to_3x3().normalized().transposed()
+        for convention, z_sign in camera_z_signs.items():
+            for row in range(3):
+                for column in range(3):
+                    node_tree.nodes[f'Pass 2 {convention} {row}{column}'].inputs[1].default_value = (
+                        camera_rotation[row][column] * (z_sign if row == 2 else 1))
+        for axis in range(3):
+            node_tree.nodes[f'Pass 3 radial {axis}'].inputs[1].default_value = camera.matrix_world.translation[axis]
+        for convention in pass_conventions[3]:
+            get_pass_node(3, convention).inputs[2].default_value = distance * 2
+
+    output_node.mute = False
+
+
+def add_verification_outputs(sample_number):
+    # writes every convention of the normals and distance passes next to the images of the sample, the node group
+    # renders of the same sample are compared with them in verify_pass_outputs
+    node_tree = bpy.context.scene.node_tree
+    output_node = node_tree.nodes['Pass Output']
+    for image_number, conventions in pass_conventions.items():
+        for convention in conventions:
+            output_node.file_slots.new(f'{sample_number}__{image_number}_{convention}_')
+            output_node.file_slots[-1].save_as_render = True
+            node_tree.links.new(get_pass_node(image_number, convention).outputs[0], output_node.inputs[-1])
+
+    logging.debug('ran "add_verification_outputs"')
+
+
+def verify_pass_outputs(folder, sample_number, tolerance):
+    # mean absolute difference (0 to 255) of every convention to the node group render. The closest convention within
+    # the tolerance is used for the rest of the run, without one the image stays with the node group
+    frame = bpy.context.scene.frame_current
+    differences = {}
+    for image_number, conventions in pass_conventions.items():
+        reference = bpy.data.images.load(f'//output/{folder}/{sample_number}__{image_number}.png')
+        reference_pixels = read_image_pixels(reference)[:, :, :3].copy()
+        bpy.data.images.remove(reference)
+
+        differences[image_number] = {}
+        for convention in conventions:
+            image_path = f'output/{folder}/{sample_number}__{image_number}_{convention}_{frame:04d}.png'
+            image = bpy.data.images.load(f'//{image_path}')
+            differences[image_number][convention] = round(
+                float(np.mean(np.abs(read_image_pixels(image)[:, :, :3] - reference_pixels))) * 255, 3)
+            bpy.data.images.remove(image)
+            os.remove(f'./{image_path}')
+
+        closest = min(differences[image_number], key=differences[image_number].get)
+        verified_conventions[image_number] = closest if differences[image_number][closest] <= tolerance else None
+        if verified_conventions[image_number] is None:
+            logging.error('No pass matches the node group render of image %s (%s), the node group is used instead',
+                          image_number, differences[image_number])
+        else:
+            logging.info('Image %s is written from the %s pass (%s)', image_number, closest, differences[image_number])
+
+    output_node = bpy.context.scene.node_tree.nodes['Pass Output']
+    while len(output_node.file_slots) > len(pass_image_numbers):
+        output_node.file_slots.remove(output_node.inputs[-1])
+    apply_verified_conventions()
+
+    logging.debug('ran "verify_pass_outputs"')
+
+    return differences
+
+
+def apply_verified_conventions():
+    # links the verified convention to the output of its image, an image without one is no longer written by the passes
+    node_tree = bpy.context.scene.node_tree
+    output_node = node_tree.nodes['Pass Output']
+    for image_number, convention in verified_conventions.items():
+        index = pass_image_numbers.index(image_number)
+        if convention is None:
+            output_node.file_slots.remove(output_node.inputs[index])
+            pass_image_numbers.remove(image_number)
+        else:
+            node_tree.links.new(get_pass_node(image_number, convention).outputs[0], output_node.inputs[index])
+
+    logging.debug('ran "apply_verified_conventions"')
+
+
+def rename_file_outputs(folder, sample_number, image_numbers):
+    # file output nodes always append the frame number
+    frame = bpy.context.scene.frame_current
+    for image_number in image_numbers:
+        os.replace(
+            f'./output/{folder}/{sample_number}__{image_number}_{frame:04d}.png',
+            f'./output/{folder}/{sample_number}__{image_number}.png'
+        )
+
+
+def disable_pass_outputs(folder, sample_number):
+    bpy.context.scene.node_tree.nodes['Pass Output'].mute = True
+    rename_file_outputs(folder, sample_number, pass_image_numbers)
+
+    logging.debug('ran "disable_pass_outputs"')
+
+
+def get_backdrops():
+    # white background planes and the image number rendered with each of them
+    return [('Plane_08', 8), ('Plane_10', 10), ('Plane_11', 11)]
+
+
+def setup_backdrop_view_layers(backdrops):
+    # every backdrop plane gets its own collection and view layer, so all of them render in one call
+    scene = bpy.context.scene
+    main_view_layer = scene.view_layers[0]
+    node_tree = scene.node_tree
+
+    collection_names = [f'Backdrop {plane_name}' for plane_name, _ in backdrops]
+    for collection_name in collection_names:
+        if collection_name not in bpy.data.collections:
+            scene.collection.children.link(bpy.data.collections.new(collection_name))
+
+    for collection_name in collection_names:
+        if collection_name not in scene.view_layers:
+            scene.view_layers.new(collection_name)
+        view_layer = scene.view_layers[collection_name]
+        view_layer.use = False
+        for other_collection_name in collection_names:
+            view_layer.layer_collection.children[other_collection_name].exclude = (
+                other_collection_name != collection_name
+            )
+        main_view_layer.layer_collection.children[collection_name].exclude = True
+
+    if 'Backdrop Output' in node_tree.nodes:
+        return
+
+    output_node = node_tree.nodes.new(type='CompositorNodeOutputFile')
+    output_node.name = 'Backdrop Output'
+    output_node.format.file_format = 'PNG'
+    output_node.format.color_mode = scene.render.image_settings.color_mode
+    output_node.format.color_depth = scene.render.image_settings.color_depth
+    output_node.format.compression = scene.render.image_settings.compression
+    output_node.file_slots.clear()
+    output_node.mute = True
+
+    for collection_name in collection_names:
+        render_layers_node = node_tree.nodes.new(type='CompositorNodeRLayers')
+        render_layers_node.layer = collection_name
+        output_node.file_slots.new(collection_name)
+        node_tree.links.new(render_layers_node.outputs["Image"], output_node.inputs[-1])
+
+    logging.debug('ran "setup_backdrop_view_layers"')
+
+
+def take_backdrop_pictures(folder, sample_number, backdrops, template=None):
+    scene = bpy.context.scene
+    node_tree = scene.node_tree
+    output_node = node_tree.nodes['Backdrop Output']
+
+    for (plane_name, image_number), file_slot in zip(backdrops, output_node.file_slots):
+        add_custom_plane(plane_name, template)
+        obj = bpy.data.objects[plane_name]
+        for collection in obj.users_collection:
+            collection.objects.unlink(obj)
+        bpy.data.collections[f'Backdrop {plane_name}'].objects.link(obj)
+        file_slot.path = f'{sample_number}__{image_number}_'
+
+    folder_path = f'./output/{folder}'
+    if not os.path.exists(folder_path):
+        os.makedirs(folder_path)
+    output_node.base_path = f'//output/{folder}/'
+
+    # only the backdrop view layers render, the main view layer never sees the planes
+    apply_render_profile('backdrop')
+    for view_layer in scene.view_layers:
+        view_layer.use = view_layer.name.startswith('Backdrop ')
+    output_node.mute = False
+    bpy.ops.render.render(write_still=False)
+    output_node.mute = True
+    for view_layer in scene.view_layers:
+        view_layer.use = not view_layer.name.startswith('Backdrop ')
+
+    rename_file_outputs(folder, sample_number, [image_number for _, image_number in backdrops])
+
+    logging.debug('ran "take_backdrop_pictures"')
+
+
+pixel_buffers = {}
+
+
+def read_image_pixels(image):
+    # foreach_get into a reused float32 buffer avoids building a python list of all pixel values
+    width, height = image.size
+    if (width, height) not in pixel_buffers:
+        pixel_buffers[(width, height)] = np.empty(width * height * 4, dtype=np.float32)
+    pixels = pixel_buffers[(width, height)]
+    image.pixels.foreach_get(pixels)
+
+    return pixels.reshape((height, width, 4))
+
+
+def is_viewer_display_encoded():
+    node_tree = bpy.context.scene.node_tree
+    return node_tree is not None and 'Viewer Display Transform' in node_tree.nodes
+
+
+def get_render_brightness():
+    scene = bpy.context.scene
+    viewer_image = bpy.data.images.get('Viewer Node')
+    image_size = (scene.render.resolution_x * scene.render.resolution_percentage // 100,
+                  scene.render.resolution_y * scene.render.resolution_percentage // 100)
+    if viewer_image is None or tuple(viewer_image.size) != image_size or not is_viewer_display_encoded():
+        return None
+
+    # exposure and view transform were applied in the compositor, the gamma comes after the display transform
+    rgb = np.clip(read_image_pixels(viewer_image)[:, :, :3], 0, 1) ** (1 / scene.view_settings.gamma)
+
+    return float(np.mean(rgb)) * 255
+
+
 def get_average_brightness(experiment_name, image_name):
+    brightness = get_render_brightness()
+    if brightness is not None:
+        return brightness
+
     pic = bpy.data.images.load(f"//output/{experiment_name}/{image_name}.png")
-    pic_array = np.array(pic.pixels[:]).reshape((1024, 1024, 4)) * 255
-    return np.mean(pic_array[:, :, :3])
+    brightness = float(np.mean(read_image_pixels(pic)[:, :, :3])) * 255
+    bpy.data.images.remove(pic)
 
+    return brightness
 
-def run_main():
 
-    logging.info("Started Program")
-    print(f"Python Version: {sys.version}")
-    print(f"Blender Version: {bpy.app.version_string}")
+def predict_hdri_strength(strength, brightness, min_brightness=50, min_strength=2.0, max_strength=54.0, gamma=2.2):
+    if brightness > min_brightness:
+        return max(strength, min_strength)
 
-    assert Path("./config.json").exists(), "config not found. copy config.json to create config_local.json!"
-    with open("./config.json") as f:
-        config = json.load(f)
+    # the mean pixel value grows roughly with strength ** (1 / gamma), aim a bit above the threshold
+    target_brightness = min_brightness * 1.2
+    new_strength = strength * (target_brightness / max(brightness, 1)) ** gamma
 
-    customize_render_quality(show_background=True, high_quality=True, image_size=1024)
-    to_skip = define_skip_assets()
-    materials = get_materials_info()
-    assets = get_assets_info()
-    experiment_number = config['experiment_number']
-    experiment_name = f'experiment_{experiment_number}'
+    return min(max(new_strength, min_strength), max_strength)
 
-    #  "beds", "cabinets",  "chairs"
-    # ["decor", "electronics", "lamps", "plants", "shelves", "sofas", "tables", "tablesets"]
-    # assets = {a: v for a, v in assets.items() if v["category"] == category}
-    # asset = assets[list(assets.keys())[i]]
 
-    # files = os.listdir("./assets/background/")
-    # exr_files = [f for f in files if f.endswith(".exr")]
+def estimate_hdri_strength(
+        experiment_name, image_name, hdri, rotation_degrees, hdri_cache=None, preview_size=128, preview_strength=2.0):
 
-    # for i, exr_file in enumerate(exr_files):
-    #     hdri = f"//assets/background/{exr_file}"
-    #     hdri_name = exr_file
+    image_size = bpy.context.scene.render.resolution_x
 
-    # for i in range(10):
-    i = experiment_number * 1000000
-    total_start_time = time.time()
+    add_world_background(hdri, preview_strength, rotation_degrees, hdri_cache=hdri_cache, proxy=True)
+    customize_render_resolution(preview_size)
+    apply_render_profile('preview')
+
+    brightness = None
+    if is_viewer_display_encoded():
+        bpy.ops.render.render(write_still=False)
+        brightness = get_render_brightness()
+    if brightness is None:
+        take_picture(experiment_name, f'{image_name}_preview')
+        brightness = get_average_brightness(experiment_name, f'{image_name}_preview')
+        os.remove(f'./output/{experiment_name}/{image_name}_preview.png')
+
+    customize_render_resolution(image_size)
 
-    for _ in range(5):
+    strength = predict_hdri_strength(preview_strength, brightness)
+    logging.info('preview brightness: %s, predicted hdri strength: %s', brightness, strength)
+
+    return strength
+
+
+def get_samples(assets, experiment_number, repetitions=5):
+    i = experiment_number * 1000000
+    samples = []
+    for _ in range(repetitions):
         for asset in assets.values():
             i += 1
+            samples.append((i, asset))
+
+    logging.debug('ran "get_samples"')
 
-            # if i > 5:
-            #     break
+    return samples
 
-            start_time = time.time()
-            # asset = get_random_asset(assets, nonrandom_asset="chair_109_01", randomness=True)
-            logging.info(f"Got asset '{asset['name']}' of type '{asset['category']}'")
 
-            if asset["name"] in to_skip:
-                continue
+def get_shard_info(config):
+    # slurm array jobs take precedence over the shard defined in the config
+    if 'SLURM_ARRAY_TASK_ID' in os.environ:
+        shard_index = int(os.environ['SLURM_ARRAY_TASK_ID']) - int(os.environ.get('SLURM_ARRAY_TASK_MIN', 0))
+        shard_count = int(os.environ.get('SLURM_ARRAY_TASK_COUNT', 1))
+    else:
+        shard_index = config.get('shard_index', 0)
+        shard_count = config.get('shard_count', 1)
 
-            remove_old_objects()
-            add_asset(f"//assets/interior_models/{asset['file']}", asset['name'], 30, randomness=True)
-            asset_size = get_asset_size(asset['name'])
-            if asset_size[2] > 2.6:
-                logging.debug('ran "asset skipped because too big"')
-                continue
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"Shard index {shard_index} is not within shard count {shard_count}")
 
-            camera_position, camera_rotation, distance, f_stop = add_camera(asset_size, randomness=True)
-            bpy.data.objects[asset['name']].rotation_euler[2] += radians(-camera_rotation)
-            asset_size = get_asset_size(asset['name'])
-            logging.debug(f'cam at: {camera_position} with distance {distance}')
+    logging.debug('ran "get_shard_info"')
 
-            add_world_background("//assets/background/abandoned_slipway_4k.exr", 1, 270, randomness=False)
-            logging.debug('added world background')
+    return shard_index, shard_count
 
-            add_asset("//assets/custom_planes/plane_08.blend", 'Plane_08', rotation_degrees=0, randomness=False)
-            logging.debug('added plane asset')
 
-            take_picture(experiment_name, f'{i}__8')
+def get_shard(samples, shard_index, shard_count):
+    # interleave samples so every shard gets a similar mix of asset categories
+    return samples[shard_index::shard_count]
 
-            for object in ["Plane_08"]:
-                bpy.data.objects[object].hide_render = True
-                bpy.data.objects[object].hide_viewport = True
 
-            add_asset("//assets/custom_planes/plane_10.blend", 'Plane_10', rotation_degrees=0, randomness=False)
-            logging.debug('added plane asset')
+def iterate_samples(samples):
+    # workers started by dispatcher.py take the next sample from the shared queue, everything else renders in order
+    address = os.environ.get('RENDER_QUEUE_ADDRESS')
+    if address is None:
+        yield from samples
+        return
+
+    host, port = address.rsplit(':', 1)
+    with Client((host, int(port)), authkey=os.environ['RENDER_QUEUE_AUTHKEY'].encode()) as connection:
+        connection.send(('size', len(samples)))
+        while True:
+            connection.send('next')
+            index = connection.recv()
+            if index >= len(samples):
+                connection.send('stop')
+                return
+            yield samples[index]
+
+
+def get_config_hash(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def get_worker_id(shard_index):
+    return f"{shard_index}_{os.environ.get('RENDER_WORKER_ID', '0')}"
+
+
+def get_sample_files(experiment_name, sample_number, image_numbers):
+    files = {}
+    for file in [f'{image_number}.png' for image_number in image_numbers] + ['0.json']:
+        file_path = f'./output/{experiment_name}/{sample_number}__{file}'
+        if os.path.isfile(file_path):
+            files[file] = os.path.getsize(file_path)
+
+    return files
+
+
+def append_to_render_manifest(experiment_name, worker_id, record):
+    # every worker appends to its own file, so lines of different workers never interleave
+    manifest_folder = f'./output/{experiment_name}/manifests'
+    os.makedirs(manifest_folder, exist_ok=True)
+    with open(f'{manifest_folder}/manifest_{worker_id}.jsonl', 'a') as f:
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+    logging.debug('ran "append_to_render_manifest"')
+
+
+def create_legacy_render_manifest(experiment_name):
+    # samples rendered before the manifests existed are indexed from the experiment folder once
+    folder_path = f'./output/{experiment_name}'
+    sample_files = {}
+    if os.path.exists(folder_path):
+        with os.scandir(folder_path) as entries:
+            for entry in entries:
+                sample_number, separator, file = entry.name.partition('__')
+                if separator and entry.is_file() and not file.endswith('.tmp'):
+                    sample_files.setdefault(sample_number, {})[file] = entry.stat().st_size
+
+    manifest_folder = f'{folder_path}/manifests'
+    os.makedirs(manifest_folder, exist_ok=True)
+    # metadata is written last, so its existence marks a finished sample
+    temporary_path = f'{manifest_folder}/manifest_legacy.jsonl.{os.getpid()}.tmp'
+    with open(temporary_path, 'w') as f:
+        for sample_number, files in sample_files.items():
+            if '0.json' in files:
+                f.write(json.dumps({'sample': int(sample_number), 'files': files}) + '\n')
+    os.replace(temporary_path, f'{manifest_folder}/manifest_legacy.jsonl')
+
+    logging.debug('ran "create_legacy_render_manifest"')
+
+
+def load_render_manifest(experiment_name):
+    if not os.path.exists(f'./output/{experiment_name}/manifests/manifest_legacy.jsonl'):
+        create_legacy_render_manifest(experiment_name)
+
+    records = {record['sample']: record for record in read_render_manifest(f'./output/{experiment_name}')}
+
+    logging.debug('ran "load_render_manifest"')
+
+    return records
+
 
-            take_picture(experiment_name, f'{i}__10')
+def get_completed_samples(experiment_name):
+    completed = set(load_render_manifest(experiment_name))
 
-            for object in ["Plane_10"]:
-                bpy.data.objects[object].hide_render = True
-                bpy.data.objects[object].hide_viewport = True
+    logging.debug('ran "get_completed_samples"')
 
-            add_asset("//assets/custom_planes/plane_11.blend", 'Plane_11', rotation_degrees=0, randomness=False)
+    return completed
+
+
+def hide_objects(object_names):
+    for object_name in object_names:
+        bpy.data.objects[object_name].hide_render = True
+        bpy.data.objects[object_name].hide_viewport = True
+
+
+def show_objects(object_names):
+    for object_name in object_names:
+        bpy.data.objects[object_name].hide_render = False
+        bpy.data.objects[object_name].hide_viewport = False
+
+
+def add_custom_plane(plane_name, template=None):
+    if template is not None and plane_name in template['objects']:
+        show_objects([plane_name])
+    else:
+        add_asset(
+            f"//assets/custom_planes/{plane_name.lower()}.blend", plane_name, rotation_degrees=0, randomness=False
+        )
+
+
+def get_node_tree_images(node_tree):
+    images = set()
+    for node in node_tree.nodes:
+        if node.type == 'TEX_IMAGE' and node.image is not None:
+            images.add(node.image.name)
+        elif node.type == 'GROUP' and node.node_tree is not None:
+            images |= get_node_tree_images(node.node_tree)
+
+    return images
+
+
+def create_scene_template():
+    template = {'objects': set(), 'meshes': set(), 'materials': set(), 'images': set(), 'worlds': set()}
+
+    for plane_name in ['Plane_04', 'Plane_08', 'Plane_10', 'Plane_11']:
+        add_custom_plane(plane_name)
+        obj = bpy.data.objects[plane_name]
+        template['objects'].add(obj.name)
+        template['meshes'].add(obj.data.name)
+        for material_slot in obj.material_slots:
+            if material_slot.material is not None:
+                template['materials'].add(material_slot.material.name)
+                if material_slot.material.use_nodes:
+                    template['images'] |= get_node_tree_images(material_slot.material.node_tree)
+
+    hide_objects(template['objects'])
+
+    for blend_path, node_group_name in [
+        ("pitch_black.blend", "get_pitch_black"),
+        ("normal.blend", "get_normal"),
+        ("distance.blend", "get_distance"),
+    ]:
+        append_node_group_from_library(blend_path, node_group_name)
+
+    scene = bpy.context.scene
+    if not scene.world:
+        scene.world = bpy.data.worlds.new(name="NewWorld")
+    scene.world.use_nodes = True
+    create_world_nodes(scene.world.node_tree)
+    template['worlds'].add(scene.world.name)
+
+    logging.debug('ran "create_scene_template"')
+
+    return template
+
+
+def merge_resident(*residents):
+    merged = {}
+    for resident in residents:
+        for key, names in resident.items():
+            merged[key] = merged.get(key, set()) | names
+
+    return merged
+
+
+def render_sample(
+        i, asset, experiment_name, materials, config, template=None, material_cache=None, hdri_cache=None,
+        worker_id='0_0', sample_timings=None):
+    start_time = time.time()
+    timer = StageTimer()
+    logging.info("Got asset '%s' of type '%s'", asset['name'], asset['category'])
+
+    resident = merge_resident(
+        template if template is not None else {},
+        material_cache.get_resident() if material_cache is not None else {},
+        hdri_cache.get_resident() if hdri_cache is not None else {},
+    )
+    with timer.stage('remove_old_objects'):
+        remove_old_objects(resident)
+        if template is not None:
+            hide_objects(template['objects'])
+    with timer.stage('add_asset'):
+        add_asset(f"//assets/interior_models/{asset['file']}", asset['name'], 30, randomness=True)
+        asset_size = get_asset_size(asset['name'])
+    if asset_size[2] > config.get('max_asset_height', 2.6):
+        logging.debug('ran "asset skipped because too big"')
+        return
+
+    with timer.stage('add_camera'):
+        camera_position, camera_rotation, distance, f_stop = add_camera(asset_size, randomness=True)
+        bpy.data.objects[asset['name']].rotation_euler[2] += radians(-camera_rotation)
+        asset_size = get_asset_size(asset['name'])
+    logging.debug('cam at: %s with distance %s', camera_position, distance)
+
+    with timer.stage('world_background'):
+        add_world_background(
+            "//assets/background/abandoned_slipway_4k.exr", 1, 270, randomness=False, hdri_cache=hdri_cache
+        )
+    logging.debug('added world background')
+
+    backdrops = get_backdrops()
+    if config.get('batch_backdrop_renders', False):
+        with timer.stage('picture_backdrops'):
+            take_backdrop_pictures(experiment_name, i, backdrops, template)
+    else:
+        for plane_name, image_number in backdrops:
+            add_custom_plane(plane_name, template)
             logging.debug('added plane asset')
 
-            take_picture(experiment_name, f'{i}__11')
+            with timer.stage(f'picture_{image_number}'):
+                take_picture(experiment_name, f'{i}__{image_number}', 'backdrop')
 
-            for object in ["Plane_11"]:
-                bpy.data.objects[object].hide_render = True
-                bpy.data.objects[object].hide_viewport = True
+            hide_objects([plane_name])
 
+    if config.get('object_index_mask', False):
+        # the mask is written from the object index pass of the beauty render
+        bpy.data.objects[asset['name']].pass_index = 1
+    else:
+        with timer.stage('mask_node_groups'):
             append_node_group_from_library("pitch_black.blend", "get_pitch_black")
             asset_materials = [ms.material for ms in bpy.data.objects[asset['name']].material_slots]
             # asset_material = bpy.data.objects[asset['name']].active_material
@@ -1354,55 +2396,228 @@ def run_main():
                     (asset_material, previous_node, previous_socket_name, output_node, uses_nodes)
                 )
 
-            add_asset("//assets/custom_planes/plane_04.blend", 'Plane_04', rotation_degrees=0, randomness=False)
+            add_custom_plane('Plane_04', template)
 
+        with timer.stage('picture_4'):
             customize_render_resolution(4096)
-            take_picture(experiment_name, f'{i}__4')
+            take_picture(experiment_name, f'{i}__4', 'mask')
             customize_render_resolution(1024)
 
+        with timer.stage('mask_node_groups'):
             for asset_material, previous_node, previous_socket_name, output_node, uses_nodes in previous_connections:
                 connect_nodes(asset_material, previous_node, previous_socket_name, output_node, "Surface", uses_nodes)
 
-            for object in ["Plane_04"]:  # , "back_left_light", "back_right_light", "front_light"]:
-                bpy.data.objects[object].hide_render = True
-                bpy.data.objects[object].hide_viewport = True
-
-            hdri, hdri_name = get_random_hdri(randomness=True)
-            room_metadata = create_room(asset_size, camera_position, materials, hdri_name, randomness=True)
-
-            loops = 0
-            hdri_brightness = 2.0
-            is_bright_enough = False
-            while not is_bright_enough:
-                add_world_background(hdri, hdri_brightness, 90, randomness=True)
-                take_picture(experiment_name, f'{i}__1')
-                brightness = get_average_brightness(experiment_name, f'{i}__1')
-                hdri_brightness *= 3
-                loops += 1
-                logging.info(f'loops: {loops}, brightness: {brightness}')
-                if brightness > 50 or loops > 3:
-                    is_bright_enough = True
+            hide_objects(["Plane_04"])  # , "back_left_light", "back_right_light", "front_light"]
 
+    with timer.stage('create_room'):
+        hdri, hdri_name = get_random_hdri(randomness=True)
+        room_metadata = create_room(
+            asset_size, camera_position, materials, hdri_name, randomness=True, material_cache=material_cache
+        )
+
+    hdri_rotation = random.random() * 360
+    if config.get('exposure_mode', 'preview') == 'preview':
+        # predict the strength from a small preview, then render once (plus a bounded number of corrections)
+        with timer.stage('exposure_preview'):
+            hdri_brightness = estimate_hdri_strength(
+                experiment_name, f'{i}__1', hdri, hdri_rotation, hdri_cache, config.get('exposure_preview_size', 128)
+            )
+        max_loops = 1 + config.get('exposure_max_corrections', 1)
+    else:
+        hdri_brightness = 2.0
+        max_loops = 4
+
+    # the first multi pass sample of a run renders the node groups as well, to pick the passes that match them
+    verify_passes = config.get('multi_pass_render', False) and not verified_conventions
+    if pass_image_numbers:
+        enable_pass_outputs(experiment_name, i, distance)
+        if verify_passes:
+            add_verification_outputs(i)
+
+    loops = 0
+    is_bright_enough = False
+    while not is_bright_enough:
+        with timer.stage('world_background'):
+            add_world_background(hdri, hdri_brightness, hdri_rotation, hdri_cache=hdri_cache)
+        with timer.stage('picture_1'):
+            take_picture(experiment_name, f'{i}__1', 'beauty')
+        with timer.stage('brightness'):
+            brightness = get_average_brightness(experiment_name, f'{i}__1')
+        loops += 1
+        logging.info('loops: %s, hdri strength: %s, brightness: %s', loops, hdri_brightness, brightness)
+        if brightness > 50 or loops >= max_loops:
+            is_bright_enough = True
+        elif config.get('exposure_mode', 'preview') == 'preview':
+            hdri_brightness = predict_hdri_strength(hdri_brightness, brightness)
+        else:
+            hdri_brightness *= 3
+
+    if pass_image_numbers:
+        disable_pass_outputs(experiment_name, i)
+
+    node_group_images = [image_number for image_number in [2, 3]
+                         if verify_passes or image_number not in pass_image_numbers]
+    if node_group_images:
+        # resident materials (hidden template planes, cached originals) are not rendered and have to stay unchanged.
+        # create_room may have added originals to the cache during this sample, so the set is taken again here
+        resident_materials = merge_resident(
+            template if template is not None else {},
+            material_cache.get_resident() if material_cache is not None else {},
+        ).get('materials', set())
+
+    if 2 in node_group_images:
+        with timer.stage('normal_node_groups'):
             append_node_group_from_library("normal.blend", "get_normal")
-            add_node_group_to_all_materials("get_normal", 'Emission')
-            take_picture(experiment_name, f'{i}__2')
+            add_node_group_to_all_materials("get_normal", 'Emission', resident_materials)
+        with timer.stage('picture_2'):
+            take_picture(experiment_name, f'{i}__2', 'data')
 
+    if 3 in node_group_images:
+        with timer.stage('distance_node_groups'):
             append_node_group_from_library("distance.blend", "get_distance")
-            add_node_group_to_all_materials("get_distance", 'Emission')
+            add_node_group_to_all_materials("get_distance", 'Emission', resident_materials)
             bpy.data.node_groups['get_distance'].nodes["Map Range"].inputs[2].default_value = distance * 2
-            take_picture(experiment_name, f'{i}__3')
+        with timer.stage('picture_3'):
+            take_picture(experiment_name, f'{i}__3', 'data')
+
+    pass_differences = None
+    if verify_passes:
+        with timer.stage('pass_verification'):
+            pass_differences = verify_pass_outputs(experiment_name, i, config.get('pass_verification_tolerance', 2))
+
+    image_profiles = {image_number: 'backdrop' for _, image_number in backdrops}
+    image_profiles[4] = 'beauty' if config.get('object_index_mask', False) else 'mask'
+    image_profiles[1] = 'beauty'
+    for image_number in [2, 3]:
+        image_profiles[image_number] = 'data' if image_number in node_group_images else 'beauty'
+
+    # how the data images were made, passes are only used in the convention that matched the node groups of the run
+    image_sources = {
+        2: 'get_normal' if 2 in node_group_images else f'normal_pass_{verified_conventions[2]}',
+        3: 'get_distance' if 3 in node_group_images else f'distance_pass_{verified_conventions[3]}',
+        4: 'object_index_pass' if config.get('object_index_mask', False) else 'get_pitch_black',
+    }
 
-            end_time = time.time()
-            time_difference = int(end_time - start_time)
-            save_metadata(
-                experiment_name, f'{i}__0', asset, camera_position, camera_rotation, distance, hdri_name,
-                time_difference, brightness, f_stop, room_metadata
-            )
+    end_time = time.time()
+    time_difference = int(end_time - start_time)
+    with timer.stage('save_metadata'):
+        save_metadata(
+            experiment_name, f'{i}__0', asset, camera_position, camera_rotation, distance, hdri_name,
+            time_difference, brightness, f_stop, room_metadata, hdri_brightness, image_profiles, image_sources
+        )
+
+    timings = timer.get_timings()
+    timings['total'] = round(time.time() - start_time, 4)
+    if sample_timings is not None:
+        sample_timings.append(timings)
+
+    # the manifest record is written after the metadata, which is the last file of the sample
+    record = {
+        'sample': i,
+        'asset': asset['name'],
+        'category': asset['category'],
+        'files': get_sample_files(experiment_name, i, sorted(image_profiles)),
+        'timings': timings,
+        'config_hash': get_config_hash(config),
+        'worker': worker_id,
+        'finished_at': time.time(),
+    }
+    if pass_differences is not None:
+        record['pass_differences'] = {str(image_number): value for image_number, value in pass_differences.items()}
+    append_to_render_manifest(experiment_name, worker_id, record)
+
+    logging.debug('ran "render_sample"')
+
+
+def run_main():
+
+    logging.info("Started Program")
+    logging.info('Python Version: %s', sys.version)
+    logging.info('Blender Version: %s', bpy.app.version_string)
+
+    assert Path("./config.json").exists(), "config not found. copy config.json to create config_local.json!"
+    with open("./config.json") as f:
+        config = json.load(f)
+
+    shard_index, shard_count = get_shard_info(config)
+    worker_id = get_worker_id(shard_index)
+    logging.set_level(config.get('log_level', 'DEBUG'))
+    if config.get('log_folder') is not None:
+        # one file per worker, so the workers of a node do not write into one shared slurm log
+        logging.set_output(f"{config['log_folder']}/render_{worker_id}.jsonl", context={'worker': worker_id})
+
+    customize_render_quality(
+        show_background=True, high_quality=True, image_size=1024, device=config.get('render_device', 'AUTO'),
+        compute_device_type=config.get('compute_device_type', 'CUDA'), threads=config.get('render_threads'),
+        cpu_tile_size=config.get('cpu_tile_size', 256)
+    )
+    setup_render_profiles(config)
+    setup_compositor()
+    if config.get('multi_pass_render', False) or config.get('object_index_mask', False):
+        setup_pass_outputs(config.get('multi_pass_render', False), config.get('object_index_mask', False))
+    if config.get('batch_backdrop_renders', False):
+        setup_backdrop_view_layers(get_backdrops())
+    to_skip = define_skip_assets()
+    materials = get_materials_info()
+    assets = get_assets_info()
+    experiment_number = config['experiment_number']
+    experiment_name = f'experiment_{experiment_number}'
+
+    #  "beds", "cabinets",  "chairs"
+    # ["decor", "electronics", "lamps", "plants", "shelves", "sofas", "tables", "tablesets"]
+    # assets = {a: v for a, v in assets.items() if v["category"] == category}
+    # asset = assets[list(assets.keys())[i]]
+
+    # sample numbers only depend on the asset order, so every shard and every restart agrees on them
+    samples = get_samples(assets, experiment_number, config.get('repetitions', 5))
+    samples = get_shard(samples, shard_index, shard_count)
+    completed_samples = get_completed_samples(experiment_name)
+    logging.info(
+        'Shard %s/%s: %s samples, %s already done',
+        shard_index + 1, shard_count, len(samples), len([i for i, _ in samples if i in completed_samples])
+    )
+
+    total_start_time = time.time()
+
+    max_height = config.get('max_asset_height', 2.6)
+    max_polygon_count = config.get('max_polygon_count')
+
+    # keep planes, node groups and the world resident instead of loading them again for every sample
+    template = None
+    if config.get('reuse_scene_template', False):
+        remove_old_objects()
+        template = create_scene_template()
+
+    material_cache = None
+    if config.get('material_cache_budget_mb', 0) > 0:
+        material_cache = MaterialCache(config['material_cache_budget_mb'])
+
+    hdri_cache = None
+    if config.get('hdri_cache_size', 0) > 0:
+        hdri_cache = HdriCache(config['hdri_cache_size'], config.get('hdri_proxy_folder'))
+
+    sample_timings = []
+    for i, asset in iterate_samples(samples):
+        logging.context['sample'] = i
+        if i in completed_samples:
+            continue
+
+        if not is_asset_accepted(asset, to_skip, max_height, max_polygon_count):
+            logging.debug("Skipped asset '%s'", asset['name'])
+            continue
+
+        render_sample(
+            i, asset, experiment_name, materials, config, template, material_cache, hdri_cache, worker_id,
+            sample_timings)
 
     total_end_time = time.time()
     total_time_difference = int(total_end_time - total_start_time)
 
-    logging.info(f'Done! {total_time_difference}s total runtime.')
+    if sample_timings:
+        summary = format_summary(summarize_timings(sample_timings))
+        logging.info('Time per stage over %s samples:\n%s', len(sample_timings), summary)
+    logging.info('Done! %ss total runtime.', total_time_difference)
 
 
-run_main()
+if __name__ == "__main__":
+    run_main()
@@ -1,7 +1,7 @@
 #!/bin/bash
 #SBATCH -p performance
 #SBATCH -t 01:00:00
-#SBATCH --gpus=1
+#SBATCH --cpus-per-task=32
 #SBATCH --job-name=blender_render
 #SBATCH --out=out.log
 #SBATCH --err=err.log
@@ -1,7 +1,7 @@
 #!/bin/bash
 #SBATCH -p performance
 #SBATCH -t 2-00:00:00
-#SBATCH --gpus=1
+#SBATCH --cpus-per-task=32
 #SBATCH --job-name=post_processing
 #SBATCH --output=outerr_pp.log
 #SBATCH --error=outerr_pp.log
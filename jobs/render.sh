@@ -6,6 +6,8 @@
 #SBATCH --output=outerr.log
 #SBATCH --error=outerr.log
 
+module load python/3.10.12
 module load singularity
 
-singularity exec --nv blender.sif blender --background --python functions/renderer.py
\ No newline at end of file
+# one blender worker per GPU, all taking samples from the same queue
+python3 functions/dispatcher.py -- singularity exec --nv blender.sif blender --background --python-exit-code 1 --python functions/renderer.py
\ No newline at end of file
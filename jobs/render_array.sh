@@ -0,0 +1,13 @@
+#!/bin/bash
+#SBATCH -p performance
+#SBATCH -t 1-00:00:00
+#SBATCH --gpus=1
+#SBATCH --array=0-19
+#SBATCH --requeue
+#SBATCH --job-name=blender_render
+#SBATCH --output=outerr_%A_%a.log
+#SBATCH --error=outerr_%A_%a.log
+
+module load singularity
+
+singularity exec --nv blender.sif blender --background --python functions/renderer.py
\ No newline at end of file